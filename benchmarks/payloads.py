@@ -0,0 +1,149 @@
+import random
+import zlib
+from datetime import date, timedelta
+from typing import Iterator, Optional
+
+# Weights of the business id (Y-tunnus) check digit.
+CHECK_DIGIT_WEIGHTS = (7, 9, 10, 5, 8, 4, 2)
+
+LANGUAGES = ("FI", "SV", "EN")
+CITIES = ("HELSINKI", "ESPOO", "TAMPERE", "VANTAA", "OULU", "TURKU", "JYVÄSKYLÄ", "KUOPIO")
+STREETS = ("Mannerheimintie", "Hämeenkatu", "Aleksanterinkatu", "Puistokatu", "Teollisuustie", "Kauppakatu")
+COMPANY_FORMS = (("OY", "Osakeyhtiö"), ("AY", "Avoin yhtiö"), ("KY", "Kommandiittiyhtiö"), ("OYJ", "Julkinen osakeyhtiö"))
+BUSINESS_LINES = (("62010", "Ohjelmistojen suunnittelu ja valmistus"), ("47110", "Päivittäistavarakauppa"),
+                  ("41200", "Asuin- ja muiden rakennusten rakentaminen"), ("70220", "Muu liikkeenjohdon konsultointi"))
+
+
+def company_number(index:int) -> Optional[str]:
+    """The business id with serial part index, None if no valid check digit exists for it."""
+    digits = f"{index:07d}"
+    remainder = sum(int(digit) * weight for digit, weight in zip(digits, CHECK_DIGIT_WEIGHTS)) % 11
+    if remainder == 1:
+        return None
+    return f"{digits}-{0 if remainder == 0 else 11 - remainder}"
+
+
+def company_numbers(count:int, start:int=1) -> Iterator[str]:
+    """Yields count valid business ids."""
+    index = start
+    while count > 0:
+        number = company_number(index)
+        index += 1
+        if number:
+            count -= 1
+            yield number
+
+
+def _count(rng:random.Random, mean:float, maximum:int, minimum:int=0) -> int:
+    # Most companies have a short history, a few have a long one.
+    return max(minimum, min(maximum, int(rng.expovariate(1 / mean)) if mean else 0))
+
+
+def _dates(rng:random.Random, start:date) -> tuple[str, Optional[str]]:
+    registration = start + timedelta(days=rng.randint(0, 8000))
+    ended = rng.random() < 0.3
+    end = registration + timedelta(days=rng.randint(30, 3000)) if ended else None
+    return registration.isoformat(), end.isoformat() if end else None
+
+
+def _history(rng:random.Random, count:int, start:date, make) -> list[dict]:
+    entries = []
+    for order in range(count):
+        registration_date, end_date = _dates(rng, start)
+        entry = make(order)
+        entry.update({"registrationDate":registration_date, "endDate":end_date, "version":1 if order == 0 else 2})
+        entries.append(entry)
+    return entries
+
+
+def generate_company(number:str, size:float=1.0) -> dict:
+    """
+    Synthetic PRH BIS v1 result for a company. The same number always gives the same payload.
+
+    Args:
+        number (str): Business id of the company.
+        size (float): Multiplier of the mean number of names, addresses, registered entries etc.
+
+    Returns:
+        dict: One item of the response's "results".
+    """
+    rng = random.Random(zlib.crc32(number.encode("utf-8")))
+    start = date(1980, 1, 1) + timedelta(days=rng.randint(0, 12000))
+    form_code, form_name = rng.choice(COMPANY_FORMS)
+    name = f"{rng.choice(('Nordic', 'Suomen', 'Uusi', 'Pohjolan', 'Helsingin'))} {rng.choice(('Rakennus', 'Data', 'Kauppa', 'Konsultointi'))} {number[:4]} {form_code}"
+
+    return {
+        "businessId":number,
+        "name":name,
+        "registrationDate":start.isoformat(),
+        "companyForm":form_code,
+        "detailsUri":None,
+        "liquidations":_history(rng, _count(rng, 0.2 * size, 3), start, lambda order: {
+            "name":"Konkurssi", "type":"KONK", "language":"FI", "source":1
+        }),
+        "names":_history(rng, _count(rng, 1.5 * size, 12, minimum=1), start, lambda order: {
+            "order":order, "name":name if order == 0 else f"{name} {order}", "language":None, "source":1
+        }),
+        "auxiliaryNames":_history(rng, _count(rng, 0.5 * size, 8), start, lambda order: {
+            "order":order, "name":f"{name.split()[0]} Toiminimi {order}", "language":None, "source":1
+        }),
+        "addresses":_history(rng, _count(rng, 2 * size, 10, minimum=1), start, lambda order: {
+            "careOf":None, "street":f"{rng.choice(STREETS)} {rng.randint(1, 120)}", "postCode":f"{rng.randint(0, 99999):05d}",
+            "type":rng.choice((1, 2)), "city":rng.choice(CITIES), "country":"FI", "language":rng.choice(LANGUAGES), "source":rng.choice((0, 1))
+        }),
+        "companyForms":_history(rng, _count(rng, 1.2 * size, 4, minimum=1), start, lambda order: {
+            "name":form_name, "type":form_code, "language":"FI", "source":1
+        }),
+        "businessLines":_history(rng, _count(rng, 1.5 * size, 6), start, lambda order: {
+            "order":order, "code":rng.choice(BUSINESS_LINES)[0], "name":rng.choice(BUSINESS_LINES)[1], "language":rng.choice(LANGUAGES), "source":2
+        }),
+        "languages":_history(rng, _count(rng, 1 * size, 3, minimum=1), start, lambda order: {
+            "name":"Suomi", "language":"FI", "source":2
+        }),
+        "registeredOffices":_history(rng, _count(rng, 1.2 * size, 5, minimum=1), start, lambda order: {
+            "order":order, "name":rng.choice(CITIES), "language":rng.choice(LANGUAGES), "source":1
+        }),
+        "contactDetails":_history(rng, _count(rng, 1.5 * size, 8), start, lambda order: {
+            "value":f"+358 {rng.randint(10, 50)} {rng.randint(1000000, 9999999)}", "type":rng.choice(("Matkapuhelin", "Kotisivun www-osoite")),
+            "language":rng.choice(LANGUAGES), "source":0
+        }),
+        "registeredEntries":[{
+            "authority":rng.randint(1, 3), "register":rng.randint(1, 8), "status":rng.randint(1, 2),
+            "registrationDate":_dates(rng, start)[0], "endDate":None, "description":"Rekisterissä", "language":rng.choice(LANGUAGES)
+        } for _ in range(_count(rng, 6 * size, 24, minimum=1))],
+        "businessIdChanges":[{
+            "source":1, "description":"Y-tunnus muutettu", "reason":"Sulautuminen", "changeDate":_dates(rng, start)[0],
+            "change":"2", "oldBusinessId":number, "newBusinessId":company_number(rng.randint(1, 9999999)), "language":"FI"
+        } for _ in range(_count(rng, 0.1 * size, 2))]
+    }
+
+
+def generate_response(number:str, size:float=1.0) -> dict:
+    """Full response body of GET /bis/v1/<number> for a synthetic company."""
+    return {
+        "type":"fi.prh.opendata.bis",
+        "version":"1",
+        "totalResults":1,
+        "resultsFrom":0,
+        "previousResultsUri":None,
+        "nextResultsUri":None,
+        "exceptionNoticeUri":None,
+        "results":[generate_company(number, size)]
+    }
+
+
+def registered_companies(start:date, end:date, per_day:int) -> list[dict]:
+    """
+    Summaries of the synthetic companies registered from start to end, up to per_day companies a day, as in the results
+    of a list query. The companies of a day are always the same.
+    """
+    results = []
+    day = start
+    while day <= end:
+        first = (day.toordinal() - date(1980, 1, 1).toordinal()) * per_day + 1
+        for number in filter(None, map(company_number, range(first, first + per_day))):
+            company = generate_company(number)
+            results.append({"businessId":number, "name":company["name"], "registrationDate":day.isoformat(),
+                            "companyForm":company["companyForm"], "detailsUri":None})
+        day += timedelta(days=1)
+    return results
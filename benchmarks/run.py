@@ -0,0 +1,217 @@
+"""
+Offline end-to-end benchmark: synthetic payloads from a local stub API, written to a local database.
+
+    python -m benchmarks.run --companies 2000 --latency 0.02 --rate_429 0.01 --writer batch --db postgresql://...
+
+Reports companies/sec, p50/p99 latency and peak RSS for the fetch (get_data), transform (Company(...)) and
+write (update_postgres, to_postgres, update_postgres_batch or CopyLoader) stages.
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional
+
+from benchmarks.payloads import company_numbers
+from benchmarks.stub_server import StubPRHServer
+
+WRITERS = ("update_postgres", "to_postgres", "batch", "copy")
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux. It is the peak of the whole process, stub server included.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(sorted_values:list[float], share:float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(share * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class StageTimer:
+    """Collects the latency of each call of a stage and the wall time of the whole stage."""
+
+    def __init__(self, name:str, unit:str="company") -> None:
+        self.name = name
+        self.unit = unit
+        self.latencies: list[float] = []
+        self.companies = 0
+        self.wall = 0.0
+        self._started = 0.0
+
+    def __enter__(self) -> "StageTimer":
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.wall = time.perf_counter() - self._started
+
+    def timed(self, func:Callable, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def report(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "stage":self.name,
+            "companies":self.companies,
+            "seconds":round(self.wall, 3),
+            "companies_per_second":round(self.companies / self.wall, 1) if self.wall else 0.0,
+            "latency_unit":self.unit,
+            "p50_ms":round(percentile(latencies, 0.50) * 1000, 3),
+            "p99_ms":round(percentile(latencies, 0.99) * 1000, 3),
+            "peak_rss_mb":round(peak_rss_mb(), 1)
+        }
+
+
+def _configure_environment(base_url:str) -> None:
+    # The prh modules read their settings on import, so this has to run before they are imported.
+    os.environ["PRH_BASE_URL"] = base_url
+    os.environ["PRH_RATE_LIMIT_CALLS"] = "1000000000"
+    os.environ["PRH_RATE_LIMIT_BURST"] = "1000000"
+    os.environ["PRH_RATE_LIMIT_DB"] = os.path.join(tempfile.mkdtemp(prefix="prh-bench-"), "ratelimit.db")
+    # A response cache would turn the fetch stage into a cache benchmark.
+    os.environ.pop("PRH_CACHE_PATH", None)
+
+
+def bench_fetch(input_rows:list[dict], fetch_workers:int) -> tuple[list[dict], StageTimer]:
+    from prh.fetch import fetch_company
+
+    timer = StageTimer("fetch")
+    with timer, ThreadPoolExecutor(fetch_workers) as executor:
+        fetched = [item for item in executor.map(lambda row: timer.timed(fetch_company, row), input_rows) if item]
+    timer.companies = len(fetched)
+    return fetched, timer
+
+
+def bench_transform(fetched:list[dict]) -> tuple[list, StageTimer]:
+    from prh.models import Company
+
+    def transform(item:dict) -> Company:
+        company = Company(company_uid=item.get("company_uid"), **item.get("data"))
+        company.base_row()
+        company.child_rows()
+        return company
+
+    timer = StageTimer("transform")
+    with timer:
+        companies = [timer.timed(transform, item) for item in fetched]
+    timer.companies = len(companies)
+    return companies, timer
+
+
+def _batches(items:list, size:int) -> Iterable[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def bench_write(companies:list, writer:str, batch_size:int) -> tuple[int, StageTimer]:
+    from prh.copy_loader import CopyLoader
+    from prh.writers import update_postgres_batch
+
+    failed = 0
+    if writer in ("update_postgres", "to_postgres"):
+        timer = StageTimer(f"write ({writer})")
+        with timer:
+            for company in companies:
+                failed += not timer.timed(getattr(company, writer))
+    else:
+        batch_writer = CopyLoader("merge").load if writer == "copy" else update_postgres_batch
+        timer = StageTimer(f"write ({writer})", unit=f"batch of {batch_size}")
+        with timer:
+            for batch in _batches(companies, batch_size):
+                failed += timer.timed(batch_writer, batch).count(False)
+    timer.companies = len(companies) - failed
+    return failed, timer
+
+
+def run_benchmark(companies:int, writer:str, db_uri:Optional[str]=None, batch_size:int=500, fetch_workers:int=4,
+                  latency:float=0.0, jitter:float=0.0, rate_429:float=0.0, payload_size:float=1.0, base_url:Optional[str]=None) -> dict:
+    """
+    Runs the fetch, transform and write stages one after the other, so each is measured on its own.
+
+    Args:
+        companies (int): Number of synthetic companies.
+        writer (str): "update_postgres", "to_postgres", "batch" (update_postgres_batch) or "copy" (CopyLoader merge).
+        db_uri (str|None): Output database, defaults to a new SQLite file. "copy" needs PostgreSQL.
+        batch_size (int): Companies per batch for "batch" and "copy".
+        fetch_workers (int): Threads calling fetch_company concurrently.
+        latency, jitter, rate_429, payload_size: Settings of the stub server, see benchmarks.stub_server.StubPRHServer.
+        base_url (str|None): Use an already running API (PRH_BASE_URL format) instead of starting the stub server.
+
+    Returns:
+        dict: Settings, stub server counts and a report per stage.
+    """
+    stub = None if base_url else StubPRHServer(latency=latency, jitter=jitter, rate_429=rate_429, payload_size=payload_size, seed=0).start()
+    try:
+        _configure_environment(base_url or stub.base_url)
+
+        from benchmarks.targets import default_target, prepare_target
+        db_uri = db_uri or default_target()
+        prepare_target(db_uri, writer)
+
+        # A new run id per run, so update_postgres never skips a company stored by an earlier run.
+        run_id = uuid.uuid4().hex[:8]
+        input_rows = [{"company_number":number, "company_uid":f"bench-{run_id}-{number}"} for number in company_numbers(companies)]
+
+        from prh.retry import api_controller
+        fetched, fetch_timer = bench_fetch(input_rows, fetch_workers)
+        retries = api_controller.stats()
+        transformed, transform_timer = bench_transform(fetched)
+        failed, write_timer = bench_write(transformed, writer, batch_size)
+    finally:
+        if stub:
+            stub.stop()
+
+    return {
+        "settings":{"companies":companies, "writer":writer, "db":db_uri.split("@")[-1], "batch_size":batch_size,
+                    "fetch_workers":fetch_workers, "latency":latency, "jitter":jitter, "rate_429":rate_429, "payload_size":payload_size},
+        "api":{"requests":stub.requests, "rejected_429":stub.rejected, **retries} if stub else None,
+        "missing":len(input_rows) - len(fetched),
+        "write_failed":failed,
+        "stages":[fetch_timer.report(), transform_timer.report(), write_timer.report()]
+    }
+
+
+def print_report(result:dict) -> None:
+    print(json.dumps(result["settings"]))
+    if result["api"]:
+        print(f"API requests: {result['api']['requests']}, answered 429: {result['api']['rejected_429']}, "
+              f"retried: {result['api']['retried']}, dropped: {result['api']['dropped']}, final concurrency limit: {result['api']['concurrency_limit']}")
+    print(f"Companies without data: {result['missing']}, failed writes: {result['write_failed']}")
+    print(f"{'stage':<26}{'companies':>10}{'seconds':>10}{'companies/s':>13}{'p50 ms':>10}{'p99 ms':>10}{'peak RSS MB':>13}  latency per")
+    for stage in result["stages"]:
+        print(f"{stage['stage']:<26}{stage['companies']:>10}{stage['seconds']:>10}{stage['companies_per_second']:>13}"
+              f"{stage['p50_ms']:>10}{stage['p99_ms']:>10}{stage['peak_rss_mb']:>13}  {stage['latency_unit']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark of fetch, transform and write")
+    parser.add_argument("--companies", type=int, default=1000)
+    parser.add_argument("--writer", choices=WRITERS, default="update_postgres")
+    parser.add_argument("--db", type=str, default=None, help="Output database URI, defaults to a temporary SQLite file")
+    parser.add_argument("--batch_size", type=int, default=500)
+    parser.add_argument("--fetch_workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub server latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds are added to the latency at random")
+    parser.add_argument("--rate_429", type=float, default=0.0, help="Share of the requests the stub answers with 429")
+    parser.add_argument("--payload_size", type=float, default=1.0, help="Multiplier of the number of names, addresses etc. per company")
+    parser.add_argument("--base_url", type=str, default=None, help="Benchmark against a running API instead of the built-in stub")
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.companies, args.writer, args.db, args.batch_size, args.fetch_workers,
+                           args.latency, args.jitter, args.rate_429, args.payload_size, args.base_url)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(result, file, indent=2)
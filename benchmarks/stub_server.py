@@ -0,0 +1,141 @@
+import json
+import random
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.payloads import generate_response, registered_companies
+
+
+class StubPRHServer:
+    """
+    Local stand-in for the PRH BIS v1 API, serving synthetic payloads from benchmarks.payloads.
+    GET /bis/v1/<business id> answers after latency (+ up to jitter) seconds, and a rate_429 share of the requests
+    get 429 Too Many Requests with a Retry-After header instead.
+    GET /bis/v1?companyRegistrationFrom=...&companyRegistrationTo=...&maxResults=...&resultsFrom=... lists
+    registrations_per_day companies for each day of the window.
+
+    Example:
+        with StubPRHServer(latency=0.05, rate_429=0.01) as server:
+            os.environ["PRH_BASE_URL"] = server.base_url
+    """
+
+    def __init__(self, port:int=0, latency:float=0.0, jitter:float=0.0, rate_429:float=0.0, retry_after:int=1,
+                 payload_size:float=1.0, seed:Optional[int]=None, registrations_per_day:int=20) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.payload_size = payload_size
+        self.registrations_per_day = registrations_per_day
+        self.requests = 0
+        self.rejected = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    @property
+    def base_url(self) -> str:
+        """Value for PRH_BASE_URL."""
+        return f"http://127.0.0.1:{self.port}/bis/v1/{{}}"
+
+    def _decide(self) -> tuple[float, bool]:
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            reject = self._random.random() < self.rate_429
+            if reject:
+                self.rejected += 1
+        return delay, reject
+
+    def _list_response(self, query:dict[str,list[str]]) -> dict:
+        def param(name:str, default:str) -> str:
+            return query.get(name, [default])[0]
+
+        start = date.fromisoformat(param("companyRegistrationFrom", date.today().isoformat()))
+        end = date.fromisoformat(param("companyRegistrationTo", date.today().isoformat()))
+        results_from = int(param("resultsFrom", "0"))
+        max_results = int(param("maxResults", "10"))
+        results = registered_companies(start, end, self.registrations_per_day)
+        page = results[results_from:results_from + max_results]
+        more = results_from + max_results < len(results)
+        return {"type":"fi.prh.opendata.bis", "version":"1", "totalResults":-1, "resultsFrom":results_from,
+                "previousResultsUri":None, "nextResultsUri":f"resultsFrom={results_from + max_results}" if more else None,
+                "exceptionNoticeUri":None, "results":page}
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                delay, reject = stub._decide()
+                time.sleep(delay)
+                if reject:
+                    self._send(429, {"message":"Too Many Requests"}, {"Retry-After":str(stub.retry_after)})
+                    return
+                url = urlsplit(self.path)
+                number = url.path.rstrip("/").rsplit("/", 1)[-1]
+                if number == "v1":
+                    self._send(200, stub._list_response(parse_qs(url.query)))
+                    return
+                self._send(200, generate_response(number, stub.payload_size))
+
+            def _send(self, status:int, body:dict, headers:Optional[dict]=None) -> None:
+                encoded = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(encoded)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(encoded)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        return Handler
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def start(self) -> "StubPRHServer":
+        """Serves in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StubPRHServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve synthetic PRH payloads")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds are added to the latency at random")
+    parser.add_argument("--rate_429", type=float, default=0.0, help="Share of the requests answered with 429")
+    args = parser.parse_args()
+
+    server = StubPRHServer(args.port, args.latency, args.jitter, args.rate_429)
+    print(f"Serving on {server.base_url}")
+    server.serve_forever()
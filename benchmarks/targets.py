@@ -0,0 +1,27 @@
+import os
+import tempfile
+
+from prh.storage import StorageBackend, open_backend
+
+# Writers that only work on PostgreSQL.
+POSTGRES_ONLY_WRITERS = ("copy",)
+
+
+def default_target() -> str:
+    """A SQLite file in a new temporary directory, so a benchmark needs no database server."""
+    return "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="prh-bench-"), "output.db")
+
+
+def prepare_target(db_uri:str, writer:str) -> StorageBackend:
+    """
+    Opens the storage backend of db_uri as the output database of the process and creates the output tables there.
+    Use an empty scratch database, the benchmark adds rows to it.
+
+    Raises:
+        ValueError: If the writer needs PostgreSQL and db_uri is not a PostgreSQL database.
+    """
+    if writer in POSTGRES_ONLY_WRITERS and not db_uri.startswith("postgresql"):
+        raise ValueError(f"Writer '{writer}' needs a PostgreSQL target, got: '{db_uri}'")
+    backend = open_backend(db_uri)
+    backend.create_tables()
+    return backend
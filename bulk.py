@@ -1,44 +1,276 @@
-from typing import Optional, Union
+import argparse
+import json
+import multiprocessing
+import time
+from datetime import date, timedelta
+from typing import Callable, Iterable, Iterator, Optional, Union
 
-from ratelimit import sleep_and_retry, limits
+from prh.archive import ArchiveWriter
+from prh.cache import response_cache
+from prh.change_feed import feed_state_name, feed_window, save_high_water_mark, select_feed_company_nums
+from prh.checkpoint import run_with_checkpoints
+from prh.copy_loader import COPY_MODES
+from prh.parquet_sink import PARQUET_BATCH_SIZE, ParquetSink
+from prh.fetch import get_data, get_data_concurrent, iter_company_nums, query_all_company_nums
+from prh.helpers import in_shard, normalize_company_number, parse_shard
+from prh.input_filter import InputFilter, expand_duplicates
+from prh.logging_config import my_project_logger
+from prh.metrics import finish_run, metrics, start_metrics_server
+from prh.pipeline import build_company, stream_upload, upload_companies
+from prh.storage import open_backend
+from prh.retry import api_controller
+from prh.refresh import REFRESH_MAX_AGE_DAYS, REFRESH_WINDOW, record_refresh_attempts, refresh_limit, select_stale_company_nums
 
-from prh.models import Company
-from prh.fetch import get_data, query_all_company_nums
+def _fetch_and_upload(input_rows:Iterable[dict], max_in_flight:int|None, stream:bool, batch_size:int|None,
+                      batch_writer:Callable, archive:ArchiveWriter|None, input_filter:InputFilter) -> list[dict[str,str|bool]]:
+    if stream:
+        return list(stream_upload(input_filter.clean_stream(input_rows), batch_size=batch_size, batch_writer=batch_writer, archive=archive))
 
-@sleep_and_retry
-@limits(calls=290, period=60)
-def bulk_run(query_statement=None) -> Union[list[dict[str,str|bool]],False]:
+    input_rows = input_filter.clean(input_rows)
+    if max_in_flight:
+        data_list = get_data_concurrent(input_rows, max_in_flight, archive)
+    else:
+        data_list = get_data(input_rows, archive)
+    if not data_list:
+        return []
+
+    company_uids = {row.get("company_uid"): row.get("company_uids") for row in input_rows}
+    fetched_items = (expanded for item in data_list for expanded in expand_duplicates(item, company_uids.get(item.get("company_uid"))))
+    companies = ((item.get("company_number"), build_company(item)) for item in fetched_items)
+    return list(upload_companies(companies, batch_size, batch_writer))
+
+def bulk_run(query_statement=None, max_in_flight:int|None=None, stream:bool=False, batch_size:int|None=None, copy_mode:str|None=None, archive_dir:str|None=None, resume:bool=False, incremental:bool=False, max_age:timedelta|None=None, limit:int|None=None, shard:tuple[int,int]|None=None, parquet_dir:str|None=None, output_uri:str|None=None, change_feed:bool=False, since:date|None=None) -> Union[list[dict[str,str|bool]],False]:
     """
     This function performs a bulk run of data retrieval and upload to the PostgreSQL database.
     It retrieves a list of company numbers from the input database, fetches data for each company number,
     and uploads the data to the output database.
-    Limiting the API calls to 290 per 60 seconds per API ratelimit.
+    Every API call draws from the shared token bucket in prh.rate_limit (290 calls per 60 seconds by default).
+    Input rows with an invalid company number are rejected before the fetch and rows with the same company number
+    are fetched once, the company is still stored for each company_uid (see prh.input_filter.InputFilter).
+
+    With the default query the run is checkpointed: the input is processed in chunks ordered by pk and after every chunk
+    the run state is stored in the output database (see prh.checkpoint). Failed companies are retried once at the end.
 
     Arguments:
         query_statemnt (): Defaults to None. SQLalchemy query statemnt created with select() function. If not specified will use default query.
+        max_in_flight (int|None): Defaults to None. If given, fetches with the asyncio engine using this many concurrent requests.
+        stream (bool): Defaults to False. If True, companies flow through bounded fetch -> transform -> upload stages
+            (see prh.pipeline) so memory stays flat and uploads start right away.
+        batch_size (int|None): Defaults to the backend's batch size (PRH_POSTGRES_BATCH_SIZE on PostgreSQL). Companies are written
+            batch_size at a time in one transaction with prh.writers.update_postgres_batch, 0 writes one company per transaction.
+        copy_mode (str|None): Defaults to None. "merge" or "replace" loads the companies with PostgreSQL COPY through staging tables
+            (see prh.copy_loader.CopyLoader). "replace" is meant for initial loads and full refreshes, it replaces all rows in the output tables.
+            It can't be combined with query_statement, incremental, change_feed or shard.
+            The replace is refused if any company failed or returned no data, see PRH_COPY_REPLACE_INCOMPLETE.
+        archive_dir (str|None): Defaults to None. If given, the raw payloads are also written to a compressed JSONL archive in this directory,
+            which replay.py can load again without the API.
+        resume (bool): Defaults to False. If True, continues the latest unfinished run from its last checkpoint. Only with the default query.
+            Returns False without processing anything if there is no unfinished run.
+        incremental (bool): Defaults to False. If True, only refreshes the input companies whose data is older than max_age, oldest first
+            and at most limit of them (see prh.refresh.select_stale_company_nums). Companies that got no data are not tried again
+            before max_age. Not checkpointed.
+        max_age (timedelta|None): Defaults to PRH_REFRESH_MAX_AGE_DAYS days. Only with incremental.
+        limit (int|None): Defaults to the number of API calls the rate limit allows in PRH_REFRESH_WINDOW seconds. Only with incremental.
+        shard (tuple[int,int]|None): Defaults to None. (index, count), only processes the companies whose company_number hashes to this
+            shard (see prh.helpers.in_shard). Shards share the API budget through the rate limiter and write through their own connections.
+        parquet_dir (str|None): Defaults to None. If given, the companies are written to partitioned Parquet files in this directory
+            instead of PostgreSQL (see prh.parquet_sink.ParquetSink). Can't be combined with copy_mode, output_uri, resume, incremental
+            or change_feed. The default query is streamed without checkpoints, so the run doesn't need the output database. Needs pyarrow.
+        output_uri (str|None): Defaults to POSTGRES_OUTPUT_DB. Output database URI, its scheme selects the storage backend,
+            e.g. "sqlite:///prh.db" for an embedded SQLite file (see prh.storage.open_backend).
+        change_feed (bool): Defaults to False. If True, only processes the companies registered since the high-water mark of the
+            change feed, listed with paged PRH list queries (see prh.change_feed). The mark moves to today when every listed company was fetched and uploaded.
+        since (date|None): Defaults to the high-water mark. Start of the change feed window. Only with change_feed.
 
     Returns:
-        upload_results (list[tuple[str,bool]]): A list of tuples containing the company number and the upload result.
+        upload_results (list[dict[str,str|bool]]): A list of dicts containing the company number, the company UID, the upload result and
+            whether the company was skipped because its payload had not changed.
     """
-    
-    input_company_nums: Optional[list[dict]] = query_all_company_nums(query_statement)
-    if not input_company_nums:
-        return False
-    
-    data_list = get_data(input_company_nums)
+    if resume and (query_statement is not None or incremental or change_feed):
+        raise ValueError("resume is only supported with the default query")
+    if change_feed and (query_statement is not None or incremental):
+        raise ValueError("change_feed can't be used together with query_statement or incremental")
+    if resume and copy_mode == "replace":
+        raise ValueError("resume can't be used with copy_mode='replace', the staged rows of the earlier run are not kept")
+    if copy_mode == "replace" and (query_statement is not None or incremental or change_feed or shard):
+        # The swap replaces the whole output tables, so the run has to load the whole input.
+        raise ValueError("copy_mode='replace' is only supported for an unsharded full run on the default query")
+    if parquet_dir and (copy_mode or output_uri):
+        raise ValueError("parquet_dir can't be used together with copy_mode or output_uri")
+    if parquet_dir and (resume or incremental or change_feed):
+        # Their state is kept in the output database, which a Parquet run doesn't use.
+        raise ValueError("parquet_dir can't be used together with resume, incremental or change_feed")
+    if copy_mode and batch_size == 0:
+        raise ValueError("copy_mode loads in batches, batch_size can't be 0")
+
+    sink = backend = None
+    if parquet_dir:
+        sink = ParquetSink(parquet_dir)
+        batch_writer = sink.load
+        batch_size = batch_size or PARQUET_BATCH_SIZE
+        # The default query is not checkpointed for Parquet, streaming it keeps the memory flat instead.
+        stream = stream or query_statement is None
+    else:
+        backend = open_backend(output_uri, copy_mode)
+        batch_writer = backend.load
+        batch_size = backend.batch_size if batch_size is None else batch_size
+
+    archive = ArchiveWriter(archive_dir) if archive_dir else None
+    input_filter = InputFilter()
+    # A replace swaps only what was loaded into the output tables, so the companies that should have been loaded are tracked.
+    expected_uids: Optional[set] = set() if copy_mode == "replace" else None
+
+    def track_expected(input_rows:Iterable[dict]) -> Iterator[dict]:
+        for row in input_rows:
+            if normalize_company_number(row.get("company_number")):
+                expected_uids.add(row.get("company_uid"))
+            yield row
 
-    upload_results = []
-    for item in data_list:
-        company_number = item.get("company_number")
-        company_uid = item.get("company_uid")
-        data = item.get("data")
+    def process(input_rows:Iterable[dict]) -> list[dict[str,str|bool]]:
+        if expected_uids is not None:
+            input_rows = track_expected(input_rows)
+        return _fetch_and_upload(input_rows, max_in_flight, stream, batch_size, batch_writer, archive, input_filter)
 
-        upload_result = Company(company_uid=company_uid, **data).update_postgres()
-        upload_results.append({"company_number":company_number, "upload_result":upload_result})
+    def shard_rows(input_rows:Iterable[dict]) -> list[dict]:
+        return [row for row in input_rows if in_shard(row.get("company_number"), shard)]
 
+    feed_end = feed_numbers = None
+    try:
+        if change_feed:
+            feed_start, feed_end = feed_window(since, feed_state_name(shard))
+            feed_rows = select_feed_company_nums(feed_start, feed_end)
+            if feed_rows is None:
+                return False
+            feed_rows = shard_rows(feed_rows)
+            feed_numbers = {normalize_company_number(row.get("company_number")) or row.get("company_number") for row in feed_rows}
+            upload_results = process(feed_rows)
+        elif incremental:
+            stale_rows = select_stale_company_nums(timedelta(days=REFRESH_MAX_AGE_DAYS) if max_age is None else max_age, limit, query_statement)
+            stale_rows = shard_rows(stale_rows)
+            upload_results = process(stale_rows)
+            if upload_results is not False:
+                record_refresh_attempts(stale_rows, upload_results)
+        elif query_statement is None and not sink:
+            upload_results = run_with_checkpoints(process, resume=resume, shard=shard)
+        elif stream:
+            upload_results = process(row for row in iter_company_nums(query_statement) if in_shard(row.get("company_number"), shard))
+        else:
+            input_company_nums: Optional[list[dict]] = query_all_company_nums(query_statement)
+            if not input_company_nums:
+                return False
+            upload_results = process(shard_rows(input_company_nums))
+    finally:
+        if archive:
+            archive.close()
+        # The files written so far are valid even if the run failed, closing them writes their footers.
+        sink_finished = sink.finish() if sink else True
+        my_project_logger.warning("Input rows: %s", input_filter.stats())
+        finish_run()
+
+    not_loaded = 0
+    if expected_uids is not None and upload_results is not False:
+        not_loaded = len(expected_uids - {result.get("company_uid") for result in upload_results})
+    if upload_results is False or (backend and not backend.finish(not_loaded)) or not sink_finished:
+        return False
+    if feed_end:
+        # Companies whose fetch failed or returned no data have no result at all, so the listed companies are compared too.
+        uploaded = {result.get("company_number") for result in upload_results if result.get("upload_result")}
+        missing = feed_numbers - uploaded
+        if missing or not all(result.get("upload_result") for result in upload_results):
+            my_project_logger.warning("Change feed high-water mark not moved, %s of %s listed companies were not uploaded", len(missing), len(feed_numbers))
+        else:
+            save_high_water_mark(feed_end, feed_state_name(shard))
     return upload_results
 
+def summarize(upload_results:list[dict[str,str|bool]]|bool) -> dict[str,int]:
+    """Counts the companies in the results of bulk_run."""
+    if not upload_results:
+        return {"companies":0, "uploaded":0, "skipped":0, "failed":0}
+    failed = sum(1 for item in upload_results if not item.get("upload_result"))
+    skipped = sum(1 for item in upload_results if item.get("skipped"))
+    return {
+        "companies":len(upload_results),
+        "uploaded":len(upload_results) - failed - skipped,
+        "skipped":skipped,
+        "failed":failed
+    }
+
+def _run_shard(shard:tuple[int,int], bulk_run_kwargs:dict) -> dict:
+    summary = summarize(bulk_run(shard=shard, **bulk_run_kwargs))
+    # bulk_run has already written the metric files of the shard.
+    summary["metrics"] = metrics.summary()
+    return summary
+
+def launch_shards(workers:int, **bulk_run_kwargs) -> dict:
+    """
+    Runs bulk_run in `workers` local processes, one shard each, and merges their summaries.
+    The processes share one API budget through the rate limiter's state file and each builds its own connection pool.
+
+    Returns:
+        dict: Summed counts of all shards, with the per-shard summaries and metrics under "shards".
+
+    Raises:
+        ValueError: With copy_mode="replace". Each shard would swap its own subset in over the whole output tables.
+    """
+    if bulk_run_kwargs.get("copy_mode") == "replace":
+        raise ValueError("copy_mode='replace' can't be used with shard workers, run it as one process")
+    # Spawned processes start clean, so no connection pool or open socket is inherited from the parent.
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers) as pool:
+        shard_summaries = pool.starmap(_run_shard, [((index, workers), bulk_run_kwargs) for index in range(workers)])
+
+    merged = {key: sum(summary[key] for summary in shard_summaries) for key in ("companies", "uploaded", "skipped", "failed")}
+    merged["shards"] = {f"{index}/{workers}": summary for index, summary in enumerate(shard_summaries)}
+    return merged
+
+def run_scheduler(max_age:timedelta, window_seconds:float=REFRESH_WINDOW, **bulk_run_kwargs) -> None:
+    """
+    Keeps refreshing the stalest companies forever. Every round refreshes at most as many companies as the rate limit
+    allows in window_seconds, and a round that finds nothing to refresh waits for a window before looking again.
+    """
+    limit = refresh_limit(window_seconds)
+    while True:
+        started = time.monotonic()
+        upload_results = bulk_run(incremental=True, max_age=max_age, limit=limit, **bulk_run_kwargs)
+        my_project_logger.warning("Incremental refresh round finished: %s", summarize(upload_results))
+
+        if not upload_results:
+            time.sleep(max(0.0, window_seconds - (time.monotonic() - started)))
+
 if __name__ == "__main__":
-    upload_result = bulk_run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", action="store_true", help="Continue the latest unfinished run from its last checkpoint")
+    parser.add_argument("--incremental", action="store_true", help="Only refresh companies older than --max_age_days, oldest first")
+    parser.add_argument("--max_age_days", type=float, help="Maximum age of the data in days for --incremental", default=REFRESH_MAX_AGE_DAYS)
+    parser.add_argument("--loop", action="store_true", help="Keep running incremental refreshes, one rate limit window at a time")
+    parser.add_argument("--shard", type=parse_shard, help="Only process shard i/N of the companies, 0 <= i < N", default=None)
+    parser.add_argument("--workers", type=int, help="Run N shards in local worker processes and print the merged summary", default=None)
+    parser.add_argument("--parquet_dir", type=str, help="Write Parquet files to this directory instead of PostgreSQL", default=None)
+    parser.add_argument("--output", type=str, help="Output database URI, e.g. sqlite:///prh.db. Defaults to POSTGRES_OUTPUT_DB", default=None)
+    parser.add_argument("--batch_size", type=int, help="Companies written per transaction, 0 writes them one by one", default=None)
+    parser.add_argument("--copy_mode", type=str, choices=COPY_MODES, help="Load with PostgreSQL COPY", default=None)
+    parser.add_argument("--change_feed", action="store_true", help="Only process the companies registered since the last change feed run")
+    parser.add_argument("--since", type=date.fromisoformat, help="Start date (YYYY-MM-DD) of the --change_feed window instead of the high-water mark", default=None)
+    args = parser.parse_args()
+
+    start_metrics_server()
+    run_kwargs = {"resume":args.resume, "incremental":args.incremental, "max_age":timedelta(days=args.max_age_days),
+                  "parquet_dir":args.parquet_dir, "output_uri":args.output, "change_feed":args.change_feed, "since":args.since,
+                  "batch_size":args.batch_size, "copy_mode":args.copy_mode}
+
+    if args.loop:
+        run_scheduler(timedelta(days=args.max_age_days), shard=args.shard, parquet_dir=args.parquet_dir, output_uri=args.output,
+                      batch_size=args.batch_size)
+
+    if args.workers:
+        print(launch_shards(args.workers, **run_kwargs))
+        raise SystemExit
+
+    upload_result = bulk_run(shard=args.shard, **run_kwargs)
     print(upload_result)
+    print(summarize(upload_result))
+    if response_cache:
+        print(response_cache.stats())
+    print(api_controller.stats())
+    print(json.dumps(metrics.summary()))
 
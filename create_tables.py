@@ -1,9 +1,15 @@
 # from decouple import config
+import argparse
 
+from prh.db import build_engine
 from prh.models import create_tables
 # from sqlalchemy import create_engine
 # from sqlalchemy.orm import sessionmaker
 
 if __name__ == "__main__":
-    create_tables()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, help="Output database URI, e.g. sqlite:///prh.db. Defaults to POSTGRES_OUTPUT_DB", default=None)
+    args = parser.parse_args()
+
+    create_tables(build_engine(args.output) if args.output else None)
     
\ No newline at end of file
@@ -0,0 +1,15 @@
+import argparse
+
+from prh.db import build_engine
+from prh.migrations import INDEX_FAILED, migrate
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", type=str, help="Output database URI, e.g. sqlite:///prh.db. Defaults to POSTGRES_OUTPUT_DB", default=None)
+    args = parser.parse_args()
+
+    report = migrate(build_engine(args.output) if args.output else None)
+    for index_name, status in report.items():
+        print(f"{index_name}: {status}")
+    if INDEX_FAILED in report.values():
+        raise SystemExit(1)
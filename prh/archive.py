@@ -0,0 +1,98 @@
+import gzip
+import json
+import os
+import threading
+import zlib
+from datetime import datetime
+from typing import Iterator, Optional
+
+from decouple import config
+
+from prh.logging_config import my_project_logger
+
+ARCHIVE_CHUNK_RECORDS = config("PRH_ARCHIVE_CHUNK_RECORDS", default=10000, cast=int)
+ARCHIVE_SUFFIX = ".jsonl.gz"
+
+
+class ArchiveWriter:
+    """
+    Append-only archive of raw PRH payloads as gzip compressed JSONL chunks.
+    A new chunk file is started every chunk_records records, existing chunks are never rewritten.
+
+    Each line is {"company_number", "company_uid", "fetched_at", "data"}, where data is the payload's results[0].
+    A company stored under several company_uids (input rows merged by prh.input_filter.InputFilter) also has "company_uids".
+    Use as a context manager or call close() so that the last chunk is flushed.
+    """
+
+    def __init__(self, directory:str, chunk_records:int=ARCHIVE_CHUNK_RECORDS) -> None:
+        self.directory = directory
+        self.chunk_records = chunk_records
+        self._run_id = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        self._chunk_index = 0
+        self._records_in_chunk = 0
+        self._file: Optional[gzip.GzipFile] = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _open_chunk(self) -> gzip.GzipFile:
+        path = os.path.join(self.directory, f"prh-{self._run_id}-{self._chunk_index:06d}{ARCHIVE_SUFFIX}")
+        self._chunk_index += 1
+        self._records_in_chunk = 0
+        return gzip.open(path, "wt", encoding="utf-8")
+
+    def write(self, company_number:str, company_uid:Optional[str], data:dict, fetched_at:Optional[datetime]=None,
+              company_uids:Optional[list[str]]=None) -> None:
+        record = {
+            "company_number":company_number,
+            "company_uid":company_uid,
+            "fetched_at":(fetched_at or datetime.now()).isoformat(),
+            "data":data
+        }
+        if company_uids and len(company_uids) > 1:
+            record["company_uids"] = company_uids
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False)
+
+        with self._lock:
+            if self._file is None or self._records_in_chunk >= self.chunk_records:
+                self.close_chunk()
+                self._file = self._open_chunk()
+            self._file.write(line)
+            self._file.write("\n")
+            self._records_in_chunk += 1
+
+    def close_chunk(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self) -> None:
+        with self._lock:
+            self.close_chunk()
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def iter_archive(directory:str) -> Iterator[dict]:
+    """
+    Reads the records of every chunk in the archive directory, oldest chunk first.
+    A chunk that was cut short, for example by a crash, is read up to its last complete record.
+
+    Yields:
+        dict: Records in format {"company_number", "company_uid", "fetched_at", "data"}.
+    """
+    chunk_names = sorted(name for name in os.listdir(directory) if name.endswith(ARCHIVE_SUFFIX))
+    for name in chunk_names:
+        path = os.path.join(directory, name)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as chunk:
+                for line in chunk:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        my_project_logger.warning("Skipping an incomplete record in archive chunk: %s", path)
+        except (EOFError, OSError, zlib.error) as e:
+            my_project_logger.warning("Archive chunk ends unexpectedly: %s, error message: %s", path, e)
@@ -0,0 +1,161 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from typing import NamedTuple, Optional
+
+from decouple import config
+
+from prh.logging_config import my_project_logger
+
+CACHE_PATH = config("PRH_CACHE_PATH", default=None)
+CACHE_TTL = config("PRH_CACHE_TTL", default=24 * 60 * 60, cast=float)
+CACHE_MAX_BYTES = config("PRH_CACHE_MAX_BYTES", default=1024 * 1024 * 1024, cast=int)
+# The total size is only checked every this many writes, summing it on every write would cost a table scan.
+EVICTION_CHECK_INTERVAL = 100
+
+
+class CachedResponse(NamedTuple):
+    data: dict
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+    fresh: bool
+
+    def conditional_headers(self) -> dict[str,str]:
+        """Headers for revalidating a stale entry with the API."""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    Persistent cache of PRH API responses in a SQLite file, keyed by company number.
+    Bodies are stored as zlib compressed JSON.
+
+    Entries younger than ttl are served without a request. Older entries are kept and revalidated with
+    ETag/Last-Modified when the API sent them. When the stored bodies exceed max_bytes the least recently
+    fetched entries are evicted.
+    """
+
+    def __init__(self, path:str, ttl:float=CACHE_TTL, max_bytes:int=CACHE_MAX_BYTES) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        if not self._initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "company_number TEXT PRIMARY KEY, body BLOB NOT NULL, etag TEXT, last_modified TEXT, "
+                "fetched_at REAL NOT NULL, size INTEGER NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS response_cache_fetched_at ON response_cache (fetched_at)")
+            self._initialized = True
+        return connection
+
+    def _count(self, counter:str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, company_number:str) -> Optional[CachedResponse]:
+        """Returns the cached response, fresh or stale, or None. Only fresh entries count as hits."""
+        try:
+            connection = self._connect()
+            try:
+                row = connection.execute(
+                    "SELECT body, etag, last_modified, fetched_at FROM response_cache WHERE company_number = ?", (company_number,)
+                ).fetchone()
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            my_project_logger.error("Response cache unavailable at %s, error message: %s", self.path, e)
+            row = None
+
+        if row is None:
+            self._count("misses")
+            return None
+
+        body, etag, last_modified, fetched_at = row
+        fresh = time.time() - fetched_at < self.ttl
+        self._count("hits" if fresh else "misses")
+        return CachedResponse(json.loads(zlib.decompress(body)), etag, last_modified, fetched_at, fresh)
+
+    def put(self, company_number:str, data:dict, etag:Optional[str]=None, last_modified:Optional[str]=None) -> None:
+        body = zlib.compress(json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+        self._execute(
+            "INSERT INTO response_cache (company_number, body, etag, last_modified, fetched_at, size) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(company_number) DO UPDATE SET body = excluded.body, etag = excluded.etag, "
+            "last_modified = excluded.last_modified, fetched_at = excluded.fetched_at, size = excluded.size",
+            (company_number, body, etag, last_modified, time.time(), len(body))
+        )
+
+        with self._lock:
+            self._writes += 1
+            check_size = self._writes % EVICTION_CHECK_INTERVAL == 0
+        if check_size:
+            self.evict()
+
+    def touch(self, company_number:str) -> None:
+        """Marks an entry fresh again after the API answered 304 Not Modified."""
+        self._count("revalidated")
+        self._execute("UPDATE response_cache SET fetched_at = ? WHERE company_number = ?", (time.time(), company_number))
+
+    def evict(self) -> int:
+        """Deletes the least recently fetched entries until the stored bodies fit in max_bytes. Returns the number of deleted entries."""
+        try:
+            connection = self._connect()
+            try:
+                total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+                if total <= self.max_bytes:
+                    return 0
+                evict_numbers = []
+                for company_number, size in connection.execute("SELECT company_number, size FROM response_cache ORDER BY fetched_at"):
+                    if total <= self.max_bytes:
+                        break
+                    evict_numbers.append((company_number,))
+                    total -= size
+                connection.execute("BEGIN")
+                connection.executemany("DELETE FROM response_cache WHERE company_number = ?", evict_numbers)
+                connection.execute("COMMIT")
+                deleted = len(evict_numbers)
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            my_project_logger.error("Couldn't evict entries from the response cache at %s, error message: %s", self.path, e)
+            return 0
+
+        with self._lock:
+            self.evicted += deleted
+        return deleted
+
+    def _execute(self, statement:str, parameters:tuple) -> None:
+        try:
+            connection = self._connect()
+            try:
+                connection.execute(statement, parameters)
+            finally:
+                connection.close()
+        except sqlite3.Error as e:
+            my_project_logger.error("Couldn't write to the response cache at %s, error message: %s", self.path, e)
+
+    def stats(self) -> dict[str,int]:
+        return {"hits":self.hits, "misses":self.misses, "revalidated":self.revalidated, "evicted":self.evicted}
+
+
+# None when PRH_CACHE_PATH is not set, the cache is optional.
+response_cache: Optional[ResponseCache] = ResponseCache(CACHE_PATH) if CACHE_PATH else None
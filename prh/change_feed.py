@@ -0,0 +1,94 @@
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from decouple import config
+
+from prh.db import get_output_session
+from prh.fetch import get_list_results, query_company_nums_by_number
+from prh.logging_config import my_project_logger
+from prh.models import ChangeFeedStateModel
+
+FEED_NAME = "company_registrations"
+# Date parameters of the list query that select the window.
+FEED_FROM_PARAM = config("PRH_FEED_FROM_PARAM", default="companyRegistrationFrom")
+FEED_TO_PARAM = config("PRH_FEED_TO_PARAM", default="companyRegistrationTo")
+# Window of the first run, when there is no high-water mark yet.
+FEED_LOOKBACK_DAYS = config("PRH_FEED_LOOKBACK_DAYS", default=7, cast=int)
+# Days before the high-water mark read again, for entries the register publishes late.
+FEED_OVERLAP_DAYS = config("PRH_FEED_OVERLAP_DAYS", default=1, cast=int)
+# What to do with companies of the feed that are not in the input: "skip" them, or store them with
+# the business id as company_uid ("business_id").
+FEED_UNKNOWN = config("PRH_FEED_UNKNOWN", default="skip")
+FEED_UNKNOWN_MODES = ("skip", "business_id")
+
+
+def feed_state_name(shard:Optional[tuple[int,int]]=None) -> str:
+    """Name of the high-water mark. Each shard keeps its own."""
+    return f"{FEED_NAME}:{shard[0]}/{shard[1]}" if shard else FEED_NAME
+
+
+def load_high_water_mark(name:str=FEED_NAME) -> Optional[date]:
+    with get_output_session() as session:
+        state = session.get(ChangeFeedStateModel, name)
+        return state.high_water_mark.date() if state else None
+
+
+def save_high_water_mark(mark:date, name:str=FEED_NAME) -> None:
+    now = datetime.now()
+    with get_output_session() as session:
+        state = session.get(ChangeFeedStateModel, name)
+        if state is None:
+            state = ChangeFeedStateModel(name=name)
+            session.add(state)
+        state.high_water_mark = datetime.combine(mark, datetime.min.time())
+        state.updated = now
+        session.commit()
+
+
+def feed_window(since:Optional[date]=None, name:str=FEED_NAME, today:Optional[date]=None) -> tuple[date,date]:
+    """
+    The date window of the next change feed run: from the high-water mark minus FEED_OVERLAP_DAYS to today.
+
+    Args:
+        since (date|None): Start of the window, overrides the high-water mark.
+        name (str): Name of the high-water mark.
+        today (date|None): End of the window, defaults to the current date.
+    """
+    today = today or date.today()
+    if since is None:
+        mark = load_high_water_mark(name)
+        since = mark - timedelta(days=FEED_OVERLAP_DAYS) if mark else today - timedelta(days=FEED_LOOKBACK_DAYS)
+    return since, today
+
+
+def select_feed_company_nums(start:date, end:date, unknown:str=FEED_UNKNOWN) -> Optional[list[dict]]:
+    """
+    Lists the companies registered between start and end with paged list queries, and maps them to input rows.
+
+    Args:
+        start (date): First registration date of the window.
+        end (date): Last registration date of the window.
+        unknown (str): "skip" leaves out the companies that are not in the input, "business_id" keeps them
+            with the business id as company_uid.
+
+    Returns:
+        list[dict]|None: Rows in format {company_number:str, company_uid:str}, None if the list query failed.
+    """
+    if unknown not in FEED_UNKNOWN_MODES:
+        raise ValueError(f"unknown must be one of {FEED_UNKNOWN_MODES}, got: '{unknown}'")
+
+    results = get_list_results({FEED_FROM_PARAM:start.isoformat(), FEED_TO_PARAM:end.isoformat()})
+    if results is None:
+        return None
+    company_numbers = list(dict.fromkeys(result.get("businessId") for result in results if result.get("businessId")))
+
+    rows = query_company_nums_by_number(company_numbers)
+    known = {row.get("company_number") for row in rows}
+    missing = [number for number in company_numbers if number not in known]
+    if unknown == "business_id":
+        rows.extend({"company_number":number, "company_uid":number} for number in missing)
+
+    my_project_logger.warning("Change feed %s - %s: %s companies listed, %s in the input, %s not in the input (%s)",
+                              start, end, len(company_numbers), len(known), len(missing),
+                              "stored" if unknown == "business_id" else "skipped")
+    return rows
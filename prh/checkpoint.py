@@ -0,0 +1,212 @@
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+from uuid import uuid4
+
+from decouple import config
+from sqlalchemy import delete, insert, select
+
+from prh.db import get_output_session
+from prh.fetch import iter_company_num_chunks, query_company_nums_by_number
+from prh.helpers import batched, company_number_variants, in_shard, normalize_company_number
+from prh.logging_config import my_project_logger
+from prh.models import BulkRunCompanyModel, BulkRunModel
+
+CHECKPOINT_CHUNK_SIZE = config("PRH_CHECKPOINT_CHUNK_SIZE", default=1000, cast=int)
+# Days the failed, missing and rejected company statuses of a finished run are kept for inspection.
+CHECKPOINT_RETENTION_DAYS = config("PRH_CHECKPOINT_RETENTION_DAYS", default=30, cast=float)
+
+# Company statuses that are retried in the last pass of a run.
+RETRY_STATUSES = ("failed", "missing")
+
+
+def _company_status(row:dict, result:Optional[dict]) -> str:
+    if result is None and normalize_company_number(row.get("company_number")) is None:
+        # Not a valid Y-tunnus, retrying won't help.
+        return "rejected"
+    if result is None:
+        # The API returned no data, the number was invalid or the request was dropped.
+        return "missing"
+    if not result.get("upload_result"):
+        return "failed"
+    return "skipped" if result.get("skipped") else "done"
+
+
+class RunCheckpoint:
+    """
+    Persists the state of a bulk run to the output database: the run id, the cursor (the last input pk of which every
+    company before it has been processed) and the status of each processed company.
+    """
+
+    def __init__(self, run_id:str, cursor_pk:Optional[str]=None) -> None:
+        self.run_id = run_id
+        self.cursor_pk = cursor_pk
+
+    @staticmethod
+    def _shard_label(shard:Optional[tuple[int,int]]) -> Optional[str]:
+        return f"{shard[0]}/{shard[1]}" if shard else None
+
+    @classmethod
+    def start(cls, shard:Optional[tuple[int,int]]=None) -> "RunCheckpoint":
+        run_id = str(uuid4())
+        now = datetime.now()
+        with get_output_session() as session:
+            session.add(BulkRunModel(run_id=run_id, status="running", shard=cls._shard_label(shard), started=now, updated=now))
+            session.commit()
+        return cls(run_id)
+
+    @classmethod
+    def latest_unfinished(cls, shard:Optional[tuple[int,int]]=None) -> Optional["RunCheckpoint"]:
+        """Returns the checkpoint of the latest run of the shard that didn't finish, None if there is none."""
+        shard_label = cls._shard_label(shard)
+        shard_filter = BulkRunModel.shard.is_(None) if shard_label is None else BulkRunModel.shard == shard_label
+        with get_output_session() as session:
+            run = session.execute(
+                select(BulkRunModel).where(BulkRunModel.status == "running", shard_filter).order_by(BulkRunModel.started.desc()).limit(1)
+            ).scalar_one_or_none()
+            if run is None:
+                return None
+            return cls(run.run_id, run.cursor_pk)
+
+    def record(self, input_rows:list[dict], upload_results:list[dict], cursor_pk:Optional[str]=None) -> None:
+        """
+        Stores the status of every input row and moves the cursor, in one transaction.
+        Input rows without an upload result are stored as "missing", or as "rejected" if their company number is invalid.
+        """
+        results_by_uid = {result.get("company_uid"): result for result in upload_results}
+        now = datetime.now()
+        rows = [{
+            "run_id": self.run_id,
+            "company_uid": row.get("company_uid"),
+            "company_number": row.get("company_number"),
+            "status": _company_status(row, results_by_uid.get(row.get("company_uid"))),
+            "updated": now
+        } for row in input_rows]
+
+        table = BulkRunCompanyModel.__table__
+        with get_output_session() as session:
+            if rows:
+                session.execute(delete(table).where(
+                    table.c.run_id == self.run_id,
+                    table.c.company_uid.in_([row["company_uid"] for row in rows])
+                ))
+                session.execute(insert(table), rows)
+
+            run = session.get(BulkRunModel, self.run_id)
+            run.updated = now
+            if cursor_pk is not None:
+                run.cursor_pk = cursor_pk
+            session.commit()
+
+        if cursor_pk is not None:
+            self.cursor_pk = cursor_pk
+
+    def recorded_uids_after(self, pk:Optional[str]) -> set[str]:
+        """company_uids after pk that already have a status in this run, i.e. were processed with an earlier chunk's duplicates."""
+        table = BulkRunCompanyModel.__table__
+        stmt = select(table.c.company_uid).where(table.c.run_id == self.run_id)
+        if pk is not None:
+            stmt = stmt.where(table.c.company_uid > pk)
+        with get_output_session() as session:
+            return set(session.execute(stmt).scalars())
+
+    def retry_rows(self) -> list[dict]:
+        """Input rows of the companies that failed or returned no data during this run."""
+        table = BulkRunCompanyModel.__table__
+        with get_output_session() as session:
+            result = session.execute(
+                select(table.c.company_number, table.c.company_uid)
+                .where(table.c.run_id == self.run_id, table.c.status.in_(RETRY_STATUSES))
+                .order_by(table.c.company_uid)
+            )
+            return [{"company_number": row.company_number, "company_uid": row.company_uid} for row in result]
+
+    def finish(self) -> None:
+        """
+        Marks the run finished and prunes bulk_run_company: the companies of this run that were uploaded or skipped,
+        and every company of the runs that finished more than PRH_CHECKPOINT_RETENTION_DAYS days ago.
+        """
+        table = BulkRunCompanyModel.__table__
+        now = datetime.now()
+        expired_runs = select(BulkRunModel.run_id).where(
+            BulkRunModel.status == "finished", BulkRunModel.finished < now - timedelta(days=CHECKPOINT_RETENTION_DAYS)
+        )
+        with get_output_session() as session:
+            run = session.get(BulkRunModel, self.run_id)
+            run.status = "finished"
+            run.finished = run.updated = now
+            session.execute(delete(table).where(table.c.run_id == self.run_id, table.c.status.in_(("done", "skipped"))))
+            session.execute(delete(table).where(table.c.run_id.in_(expired_runs)))
+            session.commit()
+
+
+def _later_duplicates(chunk:list[dict], after_pk:str, claimed:set[str]) -> list[dict]:
+    # Input rows after the chunk with the company number of a chunk row, in any spelling InputFilter normalizes.
+    numbers = {normalize_company_number(row.get("company_number")) for row in chunk}
+    variants = [variant for number in numbers if number for variant in company_number_variants(number)]
+    if not variants:
+        return []
+    return [row for row in query_company_nums_by_number(variants, start_after_pk=after_pk) if row.get("company_uid") not in claimed]
+
+
+def run_with_checkpoints(process:Callable[[list[dict]], list[dict]],
+                         resume:bool=False,
+                         chunk_size:int=CHECKPOINT_CHUNK_SIZE,
+                         shard:Optional[tuple[int,int]]=None) -> list[dict]|bool:
+    """
+    Runs process over the default input query in keyset chunks ordered by pk, checkpointing after every chunk.
+    Companies that failed or returned no data are retried once in a separate pass at the end.
+
+    The later input rows with the company number of a chunk row are processed together with the chunk, so process
+    (and its InputFilter) sees every row of a company at once and the company is fetched once per run.
+    Those rows are skipped when their own chunk comes.
+
+    Args:
+        process (Callable): Fetches and uploads a list of input rows, returns the upload results (see prh.pipeline.upload_companies).
+        resume (bool): Continue the latest unfinished run from its checkpoint instead of starting a new run.
+            Nothing is processed if there is no unfinished run.
+        chunk_size (int): Number of input rows between checkpoints.
+        shard (tuple[int,int]|None): Only processes the companies of this shard (index, count), see prh.helpers.in_shard.
+            Each shard has its own runs and checkpoints.
+
+    Returns:
+        list[dict]|bool: Upload results of the companies processed by this call, False if there was no input or no run to resume.
+    """
+    if resume:
+        checkpoint = RunCheckpoint.latest_unfinished(shard)
+        if checkpoint is None:
+            my_project_logger.warning("No unfinished bulk run to resume for shard: %s", shard)
+            return False
+        my_project_logger.warning("Resuming bulk run: %s after pk: %s", checkpoint.run_id, checkpoint.cursor_pk)
+    else:
+        checkpoint = RunCheckpoint.start(shard)
+
+    upload_results: dict[str, dict] = {}
+    input_count = 0
+    # uids after the cursor that were processed early, as duplicates of a company in an earlier chunk.
+    claimed = checkpoint.recorded_uids_after(checkpoint.cursor_pk) if resume else set()
+    for chunk in iter_company_num_chunks(checkpoint.cursor_pk, chunk_size):
+        cursor_pk = chunk[-1]["company_uid"]
+        chunk = [row for row in chunk if in_shard(row.get("company_number"), shard)]
+        input_count += len(chunk)
+        chunk_uids = {row.get("company_uid") for row in chunk}
+        chunk = [row for row in chunk if row.get("company_uid") not in claimed]
+        claimed -= chunk_uids
+        duplicates = _later_duplicates(chunk, cursor_pk, claimed)
+        claimed.update(row.get("company_uid") for row in duplicates)
+        chunk += duplicates
+        chunk_results = process(chunk) if chunk else []
+        checkpoint.record(chunk, chunk_results, cursor_pk=cursor_pk)
+        upload_results.update((result.get("company_uid"), result) for result in chunk_results)
+
+    retry_rows = checkpoint.retry_rows()
+    if retry_rows:
+        my_project_logger.warning("Retrying %s failed companies of bulk run: %s", len(retry_rows), checkpoint.run_id)
+        for chunk in batched(retry_rows, chunk_size):
+            chunk_results = process(chunk)
+            checkpoint.record(chunk, chunk_results)
+            upload_results.update((result.get("company_uid"), result) for result in chunk_results)
+
+    checkpoint.finish()
+    if not input_count and not resume:
+        return False
+    return list(upload_results.values())
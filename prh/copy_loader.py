@@ -0,0 +1,228 @@
+import tempfile
+from typing import Optional
+
+from decouple import config
+from sqlalchemy import Table
+
+from prh.db import get_output_engine
+from prh.logging_config import my_project_logger
+from prh.models import CHILD_MODELS, BaseCompanyModel, Company
+from prh.writers import unique_by_uid
+
+COPY_BATCH_SIZE = config("PRH_COPY_BATCH_SIZE", default=5000, cast=int)
+# Staged rows are kept in memory up to this many bytes per table before spilling to a temporary file.
+COPY_SPOOL_BYTES = config("PRH_COPY_SPOOL_BYTES", default=16 * 1024 * 1024, cast=int)
+
+COPY_MODES = ("merge", "replace")
+# Column added to the persistent staging tables of replace mode, the number of the load() call that staged the row.
+LOAD_SEQ_COLUMN = "_load_seq"
+# Swap the staged rows in even if some companies of the run failed or are missing, which deletes those companies.
+COPY_REPLACE_INCOMPLETE = config("PRH_COPY_REPLACE_INCOMPLETE", default=False, cast=bool)
+
+
+def _copy_value(value) -> str:
+    """Formats a value for COPY's text format."""
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def _quote(name:str) -> str:
+    return f'"{name}"'
+
+
+def _column_list(table:Table) -> str:
+    return ", ".join(_quote(column.name) for column in table.columns)
+
+
+class CopyLoader:
+    """
+    Loads companies with PostgreSQL COPY ... FROM STDIN through staging tables.
+
+    Modes:
+        merge: Every load() call copies its rows to temporary staging tables and merges them into the real tables
+            in one transaction. Company rows are upserted, and the child rows of the loaded companies are replaced.
+        replace: For full refreshes. Rows are copied to persistent staging tables over any number of load() calls and
+            finish() swaps their content into the real tables in one transaction, replacing everything in them.
+            A company staged by several load() calls, e.g. replayed from an archive of several runs, is swapped in
+            with the rows of its latest load only.
+            The swap is refused if a load failed or the caller reports missing companies, unless PRH_COPY_REPLACE_INCOMPLETE is set.
+
+    Example:
+        loader = CopyLoader("merge")
+        for batch in batches:
+            loader.load(batch)
+        loader.finish()
+    """
+
+    def __init__(self, mode:str="merge") -> None:
+        if mode not in COPY_MODES:
+            raise ValueError(f"Unknown copy mode: '{mode}', expected one of {COPY_MODES}")
+        self.mode = mode
+        # The company table first, the FK constraints of the child tables point to it.
+        self.tables: list[Table] = [model.__table__ for model in [BaseCompanyModel] + CHILD_MODELS]
+        self._staging_created = False
+        self._load_seq = 0
+        # Companies of load() calls that failed.
+        self.failed = 0
+
+    def _staging_name(self, table:Table) -> str:
+        return f"{table.name}_staging"
+
+    def _create_staging_tables(self, cursor, temporary:bool) -> None:
+        for table in self.tables:
+            staging = _quote(self._staging_name(table))
+            if temporary:
+                cursor.execute(f"CREATE TEMP TABLE {staging} (LIKE {_quote(table.name)} INCLUDING DEFAULTS) ON COMMIT DROP")
+            else:
+                cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+                cursor.execute(f"CREATE UNLOGGED TABLE {staging} (LIKE {_quote(table.name)} INCLUDING DEFAULTS)")
+                cursor.execute(f"ALTER TABLE {staging} ADD COLUMN {_quote(LOAD_SEQ_COLUMN)} bigint NOT NULL")
+
+    def _spool_rows(self, companies:list[Company], load_seq:Optional[int]=None) -> dict[str, tempfile.SpooledTemporaryFile]:
+        spools = {table.name: tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_BYTES, mode="w+", encoding="utf-8") for table in self.tables}
+        columns_by_table = {table.name: [column.name for column in table.columns] for table in self.tables}
+        suffix = f"\t{load_seq}\n" if load_seq is not None else "\n"
+
+        for company in companies:
+            rows_by_table = {BaseCompanyModel.__tablename__: [company.base_row()]}
+            for model, rows in company.child_rows().items():
+                rows_by_table[model.__tablename__] = rows
+
+            for table_name, rows in rows_by_table.items():
+                columns = columns_by_table[table_name]
+                spool = spools[table_name]
+                for row in rows:
+                    spool.write("\t".join(_copy_value(row[column]) for column in columns))
+                    spool.write(suffix)
+
+        for spool in spools.values():
+            spool.seek(0)
+        return spools
+
+    def _copy_to_staging(self, cursor, companies:list[Company], load_seq:Optional[int]=None) -> None:
+        spools = self._spool_rows(companies, load_seq)
+        try:
+            for table in self.tables:
+                columns = _column_list(table) + (f", {_quote(LOAD_SEQ_COLUMN)}" if load_seq is not None else "")
+                cursor.copy_expert(
+                    f"COPY {_quote(self._staging_name(table))} ({columns}) FROM STDIN",
+                    spools[table.name]
+                )
+        finally:
+            for spool in spools.values():
+                spool.close()
+
+    def _merge_staging(self, cursor) -> None:
+        company, children = self.tables[0], self.tables[1:]
+        columns = _column_list(company)
+        updates = ", ".join(f"{_quote(column.name)} = EXCLUDED.{_quote(column.name)}" for column in company.columns if not column.primary_key)
+        cursor.execute(
+            f"INSERT INTO {_quote(company.name)} ({columns}) SELECT {columns} FROM {_quote(self._staging_name(company))} "
+            f"ON CONFLICT (pk) DO UPDATE SET {updates}"
+        )
+        for table in children:
+            staging = _quote(self._staging_name(table))
+            columns = _column_list(table)
+            # Like update_postgres, only the tables a company has new rows for are replaced.
+            cursor.execute(f"DELETE FROM {_quote(table.name)} WHERE company_uid IN (SELECT DISTINCT company_uid FROM {staging})")
+            cursor.execute(f"INSERT INTO {_quote(table.name)} ({columns}) SELECT {columns} FROM {staging}")
+
+    def _replace_from_staging(self, cursor) -> None:
+        cursor.execute(f"TRUNCATE {', '.join(_quote(table.name) for table in self.tables)}")
+        company = self.tables[0]
+        company_staging = _quote(self._staging_name(company))
+        load_seq = _quote(LOAD_SEQ_COLUMN)
+        columns = _column_list(company)
+        # A company loaded more than once during the run keeps the rows of its latest load, in every table.
+        cursor.execute(
+            f"INSERT INTO {_quote(company.name)} ({columns}) "
+            f"SELECT DISTINCT ON (pk) {columns} FROM {company_staging} ORDER BY pk, {load_seq} DESC"
+        )
+        for table in self.tables[1:]:
+            columns = _column_list(table)
+            staged_columns = ", ".join(f"staged.{_quote(column.name)}" for column in table.columns)
+            cursor.execute(
+                f"INSERT INTO {_quote(table.name)} ({columns}) SELECT {staged_columns} FROM {_quote(self._staging_name(table))} AS staged "
+                f"JOIN (SELECT pk, max({load_seq}) AS latest FROM {company_staging} GROUP BY pk) AS loads "
+                f"ON loads.pk = staged.company_uid AND loads.latest = staged.{load_seq}"
+            )
+        for table in self.tables:
+            cursor.execute(f"DROP TABLE {_quote(self._staging_name(table))}")
+
+    def load(self, companies:list[Company]) -> list[bool]:
+        """
+        Copies a batch of companies. In merge mode the batch is committed to the real tables right away,
+        in replace mode it becomes visible when finish() is called.
+
+        Returns:
+            list[bool]: Upload result for each company, in the same order as companies.
+        """
+        if not companies:
+            return []
+
+        connection = get_output_engine().raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                if self.mode == "merge":
+                    self._create_staging_tables(cursor, temporary=True)
+                elif not self._staging_created:
+                    self._create_staging_tables(cursor, temporary=False)
+                    connection.commit()
+                    self._staging_created = True
+
+                if self.mode == "merge":
+                    self._copy_to_staging(cursor, unique_by_uid(companies))
+                else:
+                    self._load_seq += 1
+                    self._copy_to_staging(cursor, unique_by_uid(companies), self._load_seq)
+                if self.mode == "merge":
+                    self._merge_staging(cursor)
+            connection.commit()
+            return [True] * len(companies)
+
+        except Exception as e:
+            my_project_logger.error("Error copying batch of %s companies to PostgreSQL, error message: %s", len(companies), e)
+            connection.rollback()
+            self.failed += len(companies)
+            return [False] * len(companies)
+
+        finally:
+            connection.close()
+
+    def finish(self, missing:int=0) -> bool:
+        """
+        Swaps the staged rows into the real tables in replace mode. Does nothing in merge mode.
+
+        Args:
+            missing (int): Companies of the run that were not loaded, e.g. because their fetch failed. The swap would delete
+                them from the real tables, so it is refused like after a failed load, unless PRH_COPY_REPLACE_INCOMPLETE is set.
+
+        Returns:
+            bool: False if the swap failed or was refused. The real tables are then left as they were.
+        """
+        if self.mode != "replace" or not self._staging_created:
+            return True
+        if self.failed or missing:
+            if not COPY_REPLACE_INCOMPLETE:
+                my_project_logger.error("Not replacing the output tables, %s companies failed to load and %s are missing from the run. "
+                                        "Set PRH_COPY_REPLACE_INCOMPLETE=True to replace them anyway", self.failed, missing)
+                return False
+            my_project_logger.warning("Replacing the output tables although %s companies failed to load and %s are missing, "
+                                      "they are deleted from the output tables", self.failed, missing)
+
+        connection = get_output_engine().raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                self._replace_from_staging(cursor)
+            connection.commit()
+            self._staging_created = False
+            return True
+
+        except Exception as e:
+            my_project_logger.error("Error replacing tables from the staging tables, error message: %s", e)
+            connection.rollback()
+            return False
+
+        finally:
+            connection.close()
@@ -0,0 +1,76 @@
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from decouple import config
+
+POOL_SIZE = config("POSTGRES_POOL_SIZE", default=5, cast=int)
+MAX_OVERFLOW = config("POSTGRES_MAX_OVERFLOW", default=10, cast=int)
+POOL_RECYCLE = config("POSTGRES_POOL_RECYCLE", default=1800, cast=int)
+
+_lock = threading.Lock()
+_engines: dict[str, Engine] = {}
+_sessionmakers: dict[str, sessionmaker] = {}
+
+
+def build_engine(db_uri:str) -> Engine:
+    """
+    Creates an engine with the process-wide pool settings.
+    Connections are checked with pre-ping on checkout and recycled after POSTGRES_POOL_RECYCLE seconds.
+    """
+    options = {"pool_pre_ping": True, "pool_recycle": POOL_RECYCLE}
+    if not db_uri.startswith("sqlite"):
+        options.update(pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW)
+    return create_engine(db_uri, **options)
+
+
+def _get_engine(name:str, env_var:str) -> Engine:
+    engine = _engines.get(name)
+    if engine is not None:
+        return engine
+
+    with _lock:
+        if name not in _engines:
+            _engines[name] = build_engine(config(env_var))
+        return _engines[name]
+
+
+def get_output_engine() -> Engine:
+    """Returns the lazily built engine for POSTGRES_OUTPUT_DB, shared by the whole process."""
+    return _get_engine("output", "POSTGRES_OUTPUT_DB")
+
+
+def get_input_engine() -> Engine:
+    """Returns the lazily built engine for POSTGRES_INPUT_DB, shared by the whole process."""
+    return _get_engine("input", "POSTGRES_INPUT_DB")
+
+
+def set_output_engine(engine:Engine|None) -> None:
+    """Injects the engine used for the output database, for example a local database in tests and benchmarks. None resets it."""
+    _set_engine("output", engine)
+
+
+def set_input_engine(engine:Engine|None) -> None:
+    """Injects the engine used for the input database. None resets it."""
+    _set_engine("input", engine)
+
+
+def _set_engine(name:str, engine:Engine|None) -> None:
+    with _lock:
+        old_engine = _engines.pop(name, None)
+        _sessionmakers.pop(name, None)
+        if engine is not None:
+            _engines[name] = engine
+    if old_engine is not None and old_engine is not engine:
+        old_engine.dispose()
+
+
+def get_output_session():
+    """Returns a new session bound to the shared output engine."""
+    Session = _sessionmakers.get("output")
+    if Session is None:
+        engine = get_output_engine()
+        with _lock:
+            Session = _sessionmakers.setdefault("output", sessionmaker(bind=engine))
+    return Session()
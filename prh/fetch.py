@@ -1,42 +1,112 @@
+import asyncio
+import threading
+import time
+from functools import lru_cache
+from typing import Iterator
+from urllib.parse import urlencode
+
+import aiohttp
 import requests
-from sqlalchemy import create_engine, Table, MetaData, select
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Table, MetaData, select
+from sqlalchemy.engine import Engine
 from decouple import config
 
-from prh.logging_config import my_project_logger
+from prh.archive import ArchiveWriter
+from prh.cache import response_cache
+from prh.db import get_input_engine
+from prh.logging_config import REPEAT_LIMITED, my_project_logger
 from prh.helpers import is_valid_company_number
+from prh.metrics import metrics, profiler
+from prh.rate_limit import api_rate_limiter
+from prh.retry import CONNECTION_ERROR, api_controller
+
+BASE_URL = config("PRH_BASE_URL", default="https://avoindata.prh.fi/bis/v1/{}")
+MAX_IN_FLIGHT = config("PRH_MAX_IN_FLIGHT", default=10, cast=int)
+INPUT_YIELD_PER = config("PRH_INPUT_YIELD_PER", default=10000, cast=int)
+# List queries, e.g. https://avoindata.prh.fi/bis/v1?companyRegistrationFrom=2024-01-01&maxResults=1000&resultsFrom=0
+LIST_URL = config("PRH_LIST_URL", default=BASE_URL.rsplit("/", 1)[0])
+LIST_PAGE_SIZE = config("PRH_LIST_PAGE_SIZE", default=1000, cast=int)
+REQUEST_TIMEOUT = config("PRH_REQUEST_TIMEOUT", default=30, cast=float)
+
+_http_local = threading.local()
+
+def _http_session() -> requests.Session:
+    # One session per thread keeps the connections to the API alive between requests.
+    session = getattr(_http_local, "session", None)
+    if session is None:
+        session = _http_local.session = requests.Session()
+    return session
 
-BASE_URL = "https://avoindata.prh.fi/bis/v1/{}"
+def _request(search_url:str, headers:dict|None) -> requests.Response|None:
+    """One rate limited request through the retry controller. Returns None if the request failed."""
+    with metrics.rate_limit_wait_seconds.time():
+        api_rate_limiter.acquire()
+    with api_controller.slot(), metrics.fetch_seconds.time():
+        try:
+            response = _http_session().get(search_url, headers=headers, timeout=REQUEST_TIMEOUT)
+        except requests.RequestException as e:
+            my_project_logger.warning("Request failed for url: '%s', error message: %s", search_url, e, extra=REPEAT_LIMITED)
+            response = None
+    status = response.status_code if response is not None else CONNECTION_ERROR
+    metrics.api_responses.inc(status=str(status) if response is not None else "error")
+    api_controller.record(status)
+    return response
+
+def _get_with_retries(url:str, headers:dict|None=None) -> requests.Response|None:
+    """GET through _request, retried as long as the retry controller allows. Returns the last response, None if the request failed."""
+    attempt = 0
+    while True:
+        response = _request(url, headers)
+        status = response.status_code if response is not None else CONNECTION_ERROR
+        if not api_controller.should_retry(status, attempt):
+            return response
+        time.sleep(api_controller.delay(attempt, response.headers.get("Retry-After") if response is not None else None))
+        attempt += 1
 
 def get_response(company_number:str|None) -> dict|None:
     """Get's the API response for the company number provided.
+    429, 5xx responses and connection errors are retried with backoff, see prh.retry.RetryController.
 
     Args:
         company_number (str): Finnish company's "y-tunnus". Example "1234567-8". Length should always be 9 chars and no letters.
 
     Returns:
-        dict: JSON response from the API
+        dict: JSON response from the API, or from the response cache when PRH_CACHE_PATH is set and the entry is fresh.
     """
     if is_valid_company_number(company_number) is False:
-        my_project_logger.warning(f"Company number is not in correct format: '{company_number}' won't fetch data for it.")
+        my_project_logger.warning("Company number is not in correct format: '%s' won't fetch data for it.", company_number, extra=REPEAT_LIMITED)
         return None
 
+    cached = response_cache.get(company_number) if response_cache else None
+    if cached and cached.fresh:
+        return cached.data
+
     search_url = BASE_URL.format(company_number)
 
-    response = requests.get(search_url)
+    response = _get_with_retries(search_url, cached.conditional_headers() if cached else None)
+    if response is None:
+        return None
+
+    if response.status_code == 304 and cached:
+        response_cache.touch(company_number)
+        return cached.data
 
     if response.status_code != 200:
-        my_project_logger.warning(f"Couldn't get a response for company_number: '{company_number}', response status code: {response.status_code}")
+        my_project_logger.warning("Couldn't get a response for company_number: '%s', response status code: %s", company_number, response.status_code, extra=REPEAT_LIMITED)
         return None
 
-    return response.json()
+    data = response.json()
+    if response_cache:
+        response_cache.put(company_number, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return data
 
-def get_data(company_numbers:list[dict[str,str]]|None) -> list[dict[str, str|None ,str|dict|None]]:
+def get_data(company_numbers:list[dict[str,str]]|None, archive:ArchiveWriter|None=None) -> list[dict[str, str|None ,str|dict|None]]:
     """
     Get data for a list of company numbers.
     
     Args:
         company_numbers (list[dict[str,str]]|None): List of dictionaries containing company numbers and company UIDs. Format [{company_number:str, company_uid:str}].
+        archive (ArchiveWriter|None): If given, every payload is also written to this raw response archive.
     
     Returns:
         list[tuple[str,str|None,dict]]: List of tuples containing company number, company UID, and data.
@@ -47,48 +117,294 @@ def get_data(company_numbers:list[dict[str,str]]|None) -> list[dict[str, str|Non
     
     data_list = []
     for item in company_numbers:
-        number = item.get("company_number")
-        company_uid = item.get("company_uid")
-
-        data = get_response(number)
-        if not data:
-            my_project_logger.info(f"No data returned for company: {number}")
-            continue
-
-        data = data.get("results")
-        if not data:
-            my_project_logger.info(f"No data returned for company: {number}")
-            continue
-        # When requesting the API with the company number, it won't return more than one result.
-        data = data[0]
-        data_list.append({"company_number":number, "company_uid":company_uid, "data":data})
+        fetched = fetch_company(item, archive)
+        if fetched:
+            data_list.append(fetched)
 
     return data_list
 
+def fetch_company(item:dict[str,str], archive:ArchiveWriter|None=None) -> dict[str, str|None ,str|dict|None]|None:
+    """
+    Get data for a single input row.
+
+    Args:
+        item (dict[str,str]): Input row in format {company_number:str, company_uid:str}.
+        archive (ArchiveWriter|None): If given, the payload is also written to this raw response archive.
+
+    Returns:
+        dict|None: {company_number, company_uid, data} as in get_data's list, None if there was no data.
+    """
+    number = item.get("company_number")
+    with profiler.maybe_profile():
+        data = _first_result(number, get_response(number))
+    if not data:
+        return None
+    if archive:
+        archive.write(number, item.get("company_uid"), data, company_uids=item.get("company_uids"))
+    return {"company_number":number, "company_uid":item.get("company_uid"), "data":data}
+
+def _first_result(company_number:str|None, data:dict|None) -> dict|None:
+    if not data:
+        my_project_logger.info("No data returned for company: %s", company_number, extra=REPEAT_LIMITED)
+        return None
+
+    data = data.get("results")
+    if not data:
+        my_project_logger.info("No data returned for company: %s", company_number, extra=REPEAT_LIMITED)
+        return None
+    # When requesting the API with the company number, it won't return more than one result.
+    return data[0]
+
+async def get_response_async(http_session:aiohttp.ClientSession, company_number:str|None) -> dict|None:
+    """Async counterpart of get_response, issued through a shared aiohttp session so connections are kept alive.
+
+    Args:
+        http_session (aiohttp.ClientSession): Open session whose connection pool is reused between requests.
+        company_number (str): Finnish company's "y-tunnus". Example "1234567-8".
+
+    Returns:
+        dict: JSON response from the API
+    """
+    if is_valid_company_number(company_number) is False:
+        my_project_logger.warning("Company number is not in correct format: '%s' won't fetch data for it.", company_number, extra=REPEAT_LIMITED)
+        return None
+
+    cached = response_cache.get(company_number) if response_cache else None
+    if cached and cached.fresh:
+        return cached.data
+
+    search_url = BASE_URL.format(company_number)
+
+    attempt = 0
+    while True:
+        with metrics.rate_limit_wait_seconds.time():
+            await api_rate_limiter.acquire_async()
+        retry_after = None
+        try:
+            async with api_controller.slot_async():
+                with metrics.fetch_seconds.time():
+                    async with http_session.get(search_url, headers=cached.conditional_headers() if cached else None) as response:
+                        status = response.status
+                        metrics.api_responses.inc(status=str(status))
+                        api_controller.record(status)
+                        if not api_controller.should_retry(status, attempt):
+                            return await _read_response_async(company_number, response, cached)
+                        retry_after = response.headers.get("Retry-After")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.api_responses.inc(status="error")
+            api_controller.record(CONNECTION_ERROR)
+            my_project_logger.warning("Request failed for company_number: '%s', error message: %s", company_number, e, extra=REPEAT_LIMITED)
+            if not api_controller.should_retry(CONNECTION_ERROR, attempt):
+                return None
+        await asyncio.sleep(api_controller.delay(attempt, retry_after))
+        attempt += 1
+
+async def _read_response_async(company_number:str, response:aiohttp.ClientResponse, cached) -> dict|None:
+    if response.status == 304 and cached:
+        response_cache.touch(company_number)
+        return cached.data
+    if response.status != 200:
+        my_project_logger.warning("Couldn't get a response for company_number: '%s', response status code: %s", company_number, response.status, extra=REPEAT_LIMITED)
+        return None
+    data = await response.json(content_type=None)
+    if response_cache:
+        response_cache.put(company_number, data, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return data
+
+async def get_data_async(company_numbers:list[dict[str,str]]|None, max_in_flight:int|None=None, archive:ArchiveWriter|None=None) -> list[dict[str, str|None ,str|dict|None]]:
+    """
+    Get data for a list of company numbers with up to max_in_flight concurrent requests.
+    Results are returned in completion order, not in input order.
+
+    Args:
+        company_numbers (list[dict[str,str]]|None): List of dictionaries containing company numbers and company UIDs. Format [{company_number:str, company_uid:str}].
+        max_in_flight (int|None): Maximum number of concurrent requests. Defaults to PRH_MAX_IN_FLIGHT.
+        archive (ArchiveWriter|None): If given, every payload is also written to this raw response archive.
+
+    Returns:
+        list[dict]: Same format as get_data.
+    """
+    if not company_numbers:
+        return None
+
+    max_in_flight = max_in_flight or MAX_IN_FLIGHT
+    data_list = []
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max_in_flight * 2)
+
+    async def worker(http_session:aiohttp.ClientSession):
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                number = item.get("company_number")
+                data = _first_result(number, await get_response_async(http_session, number))
+                if data:
+                    if archive:
+                        archive.write(number, item.get("company_uid"), data, company_uids=item.get("company_uids"))
+                    data_list.append({"company_number":number, "company_uid":item.get("company_uid"), "data":data})
+            except Exception as e:
+                # E.g. a 200 response whose body is not JSON. A dead worker would stop draining the queue.
+                my_project_logger.error("Error fetching company_number: '%s', error message: %s", item.get("company_number"), e, extra=REPEAT_LIMITED)
+            finally:
+                queue.task_done()
+
+    connector = aiohttp.TCPConnector(limit=max_in_flight, keepalive_timeout=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)) as http_session:
+        workers = [asyncio.create_task(worker(http_session)) for _ in range(max_in_flight)]
+        for item in company_numbers:
+            await queue.put(item)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+
+    return data_list
+
+def get_data_concurrent(company_numbers:list[dict[str,str]]|None, max_in_flight:int|None=None, archive:ArchiveWriter|None=None) -> list[dict[str, str|None ,str|dict|None]]:
+    """Blocking wrapper around get_data_async, usable wherever get_data is."""
+    return asyncio.run(get_data_async(company_numbers, max_in_flight, archive))
+
+def get_list_page(params:dict[str,str|int]) -> dict|None:
+    """
+    Gets one page of a PRH list query. Rate limited and retried like get_response.
+
+    Args:
+        params (dict): Query parameters, e.g. {"companyRegistrationFrom":"2024-01-01", "maxResults":1000, "resultsFrom":0}.
+
+    Returns:
+        dict|None: JSON response from the API, with an empty "results" list if nothing matched. None if the request failed.
+    """
+    response = _get_with_retries(f"{LIST_URL}?{urlencode(params)}")
+    if response is None:
+        return None
+    # The API answers a query without matches with 404.
+    if response.status_code == 404:
+        return {"results":[]}
+    if response.status_code != 200:
+        my_project_logger.warning("Couldn't get a response for list query: %s, response status code: %s", params, response.status_code)
+        return None
+    return response.json()
+
+def get_list_results(params:dict[str,str|int], page_size:int=LIST_PAGE_SIZE) -> list[dict]|None:
+    """
+    Pages through a PRH list query with maxResults and resultsFrom. Each page is one API call,
+    so a query returning n companies costs n / page_size calls instead of n.
+
+    Args:
+        params (dict): Filters of the query, e.g. {"companyRegistrationFrom":"2024-01-01"}.
+        page_size (int): maxResults of each page. The API allows at most 1000.
+
+    Returns:
+        list[dict]|None: The "results" of all pages, None if any page couldn't be fetched.
+    """
+    results = []
+    while True:
+        page = get_list_page({**params, "totalResults":"false", "maxResults":page_size, "resultsFrom":len(results)})
+        if page is None:
+            return None
+        page_results = page.get("results") or []
+        results.extend(page_results)
+        if len(page_results) < page_size or not page.get("nextResultsUri", True):
+            return results
+
+
+@lru_cache(maxsize=None)
+def _input_company_table(engine:Engine) -> Table:
+    # Reflects only the "company" table instead of the whole input schema.
+    return Table("company", MetaData(), autoload_with=engine)
+
+def _default_input_query(company:Table, start_after_pk:str|None=None):
+    stmt = select(company.c.company_number, company.c.pk).where(company.c.country_code == "FI")
+    if start_after_pk is not None:
+        stmt = stmt.where(company.c.pk > start_after_pk)
+    return stmt.order_by(company.c.pk)
+
+def iter_company_nums(query_statement=None, start_after_pk:str|None=None, yield_per:int=INPUT_YIELD_PER) -> Iterator[dict]:
+    """
+    Streams the input rows through a server-side cursor instead of loading them all into memory.
+
+    Args:
+        query_statement (): Defaults to None. SQLalchemy query statement created with select() function. If not specified will use default query.
+        start_after_pk (str|None): Only used with the default query. Starts reading after this pk, the default query is ordered by pk.
+        yield_per (int): Number of rows fetched from the cursor at a time.
+
+    Yields:
+        dict: Rows in format {company_number:str, company_uid:str}.
+    """
+    engine = get_input_engine()
+    stmt = query_statement if query_statement is not None else _default_input_query(_input_company_table(engine), start_after_pk)
 
-def query_all_company_nums(query_statement=None) -> list[dict]:
-    input_db_uri = config("POSTGRES_INPUT_DB")
-    engine = create_engine(input_db_uri)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    metadata = MetaData()
-    metadata.reflect(bind=engine)
-    company = metadata.tables["company"]
-
-    if query_statement:
-        stmt = query_statement
-    else:
-        
-        stmt = select(company.c.company_number, company.c.pk).where(company.c.country_code == "FI")
-    
     try:
-        result = session.execute(stmt).fetchall()
-        return [{"company_number": row.company_number, "company_uid": row.pk} for row in result]
-    
+        with engine.connect() as connection:
+            result = connection.execution_options(stream_results=True, yield_per=yield_per).execute(stmt)
+            for row in result:
+                yield {"company_number": row.company_number, "company_uid": row.pk}
     except Exception as e:
-        my_project_logger.error(f"Error querying db address: {input_db_uri}, error message: {str(e)}", exc_info=True)
+        my_project_logger.error("Error querying db address: %r, error message: %s", engine.url, e, exc_info=True)
+        raise
+
+def iter_company_num_chunks(start_after_pk:str|None=None, chunk_size:int=INPUT_YIELD_PER) -> Iterator[list[dict]]:
+    """
+    Reads the default input query in keyset-paginated chunks ordered by pk.
+    Every chunk is a separate short query, so a reader can stop and later continue from the last pk it saw.
+
+    Args:
+        start_after_pk (str|None): Starts reading after this pk. None starts from the beginning.
+        chunk_size (int): Maximum number of rows in a chunk.
+
+    Yields:
+        list[dict]: Chunks of rows in format {company_number:str, company_uid:str}.
+    """
+    engine = get_input_engine()
+    company = _input_company_table(engine)
+
+    while True:
+        stmt = _default_input_query(company, start_after_pk).limit(chunk_size)
+        with engine.connect() as connection:
+            chunk = [{"company_number": row.company_number, "company_uid": row.pk} for row in connection.execute(stmt)]
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        start_after_pk = chunk[-1]["company_uid"]
+
+def query_all_company_nums(query_statement=None) -> list[dict]:
+    try:
+        return list(iter_company_nums(query_statement))
+
+    except Exception:
+        # iter_company_nums has already logged the error.
         return None
-    
-    finally:
-        session.close()
+
+def query_company_nums_by_number(company_numbers:list[str], chunk_size:int=INPUT_YIELD_PER, start_after_pk:str|None=None) -> list[dict]:
+    """
+    Input rows of the given company numbers, read with the default input query.
+    With start_after_pk only the rows after that pk are read.
+
+    Returns:
+        list[dict]: Rows in format {company_number:str, company_uid:str}. A company number may have several rows, numbers not in the input have none.
+    """
+    engine = get_input_engine()
+    company = _input_company_table(engine)
+    rows = []
+    with engine.connect() as connection:
+        for start in range(0, len(company_numbers), chunk_size):
+            stmt = _default_input_query(company, start_after_pk).where(company.c.company_number.in_(company_numbers[start:start + chunk_size]))
+            rows.extend({"company_number": row.company_number, "company_uid": row.pk} for row in connection.execute(stmt))
+    return rows
+
+def query_company_nums_by_uid(company_uids:list[str], query_statement=None) -> list[dict]:
+    """
+    Input rows of the given company_uids, read with query_statement or the default input query.
+
+    Returns:
+        list[dict]: Rows in format {company_number:str, company_uid:str}, in the order of company_uids. Uids not in the input have none.
+    """
+    if not company_uids:
+        return []
+    engine = get_input_engine()
+    rows = (query_statement if query_statement is not None else _default_input_query(_input_company_table(engine))).subquery()
+    with engine.connect() as connection:
+        by_uid = {row.pk: row.company_number for row in connection.execute(select(rows).where(rows.c.pk.in_(company_uids)))}
+    return [{"company_number": by_uid[uid], "company_uid": uid} for uid in company_uids if uid in by_uid]
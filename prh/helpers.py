@@ -1,6 +1,10 @@
 from datetime import datetime
-from typing import Optional
+from typing import Iterable, Iterator, Optional
+import hashlib
+import itertools
+import json
 import re
+import zlib
 
 def as_timestamp(string:str|None) -> datetime|None:
     if not string:
@@ -54,16 +58,126 @@ def convert_address_type(value:int) -> Optional[int]:
     }
     return address_types.get(value)
 
+# Weights of the Y-tunnus check digit, for the seven digits before the dash.
+CHECK_DIGIT_WEIGHTS = (7, 9, 10, 5, 8, 4, 2)
+# Accepts the official "1234567-8" and the common variants without the dash or the leading zero ("12345678", "234567-8").
+COMPANY_NUMBER_PATTERN = re.compile(r"(\d{6,7})-?(\d)")
+
+# Rejection reasons of parse_company_number.
+REJECTED_FORMAT = "format"
+REJECTED_CHECK_DIGIT = "check_digit"
+
+def _weighted_remainders(weights:tuple[int, ...]) -> dict[str,int]:
+    return {"".join(digits): sum(int(digit) * weight for digit, weight in zip(digits, weights)) % 11
+            for digits in itertools.product("0123456789", repeat=len(weights))}
+
+# Weighted digit sums mod 11 of the first four and the last three digits, precomputed so a check digit
+# costs two dict lookups instead of seven multiplications. 11 000 entries in total.
+_HEAD_REMAINDERS = _weighted_remainders(CHECK_DIGIT_WEIGHTS[:4])
+_TAIL_REMAINDERS = _weighted_remainders(CHECK_DIGIT_WEIGHTS[4:])
+
+def company_number_check_digit(digits:str) -> Optional[int]:
+    """
+    Mod-11 check digit of a Y-tunnus.
+
+    Args:
+        digits (str): The seven digits before the dash.
+
+    Returns:
+        int|None: The check digit, None if no business id can have these digits (remainder 1).
+    """
+    remainder = (_HEAD_REMAINDERS[digits[:4]] + _TAIL_REMAINDERS[digits[4:]]) % 11
+    if remainder == 1:
+        return None
+    return 0 if remainder == 0 else 11 - remainder
+
+def parse_company_number(value:Optional[str]) -> tuple[Optional[str], Optional[str]]:
+    """
+    Normalizes a company number to the "1234567-8" format and validates its check digit.
+
+    Args:
+        value (str|None): Company number, with or without the dash and the leading zero. Surrounding whitespace is ignored.
+
+    Returns:
+        tuple[str|None, str|None]: The normalized company number and None, or None and the rejection reason
+            (REJECTED_FORMAT or REJECTED_CHECK_DIGIT).
+    """
+    match = COMPANY_NUMBER_PATTERN.fullmatch(value.strip()) if isinstance(value, str) else None
+    if match is None:
+        return None, REJECTED_FORMAT
+    digits = match.group(1).zfill(7)
+    if company_number_check_digit(digits) != int(match.group(2)):
+        return None, REJECTED_CHECK_DIGIT
+    return f"{digits}-{match.group(2)}", None
+
+def normalize_company_number(value:Optional[str]) -> Optional[str]:
+    """The company number in the "1234567-8" format, None if it is not a valid Y-tunnus. See parse_company_number."""
+    return parse_company_number(value)[0]
+
+def company_number_variants(company_number:str) -> list[str]:
+    """The spellings of a normalized company number that parse_company_number accepts, surrounding whitespace aside."""
+    digits, check_digit = company_number.split("-")
+    variants = [company_number, f"{digits}{check_digit}"]
+    if digits.startswith("0"):
+        variants += [f"{digits[1:]}-{check_digit}", f"{digits[1:]}{check_digit}"]
+    return variants
+
 def is_valid_company_number(s: str) -> bool:
     """
-    Checks if a string is in the format: first 7 characters are numbers, then a dash, and then a number again.
-    The total length of the string should be 9, which contains 8 numbers and a dash as the 8th character.
+    Checks if a string is a valid company number in the official format: 7 numbers, a dash and a check digit,
+    e.g. "1234567-8", where the check digit matches the other digits (mod-11).
 
     Args:
         s (str): The string to check. A finnish company_number.
 
     Returns:
-        bool: True if the string is in the correct format, False otherwise.
+        bool: True if the string is in the correct format and its check digit is correct, False otherwise.
+            Always False for a value that is not a string, e.g. None.
+    """
+    if not isinstance(s, str):
+        return False
+    return normalize_company_number(s) == s
+
+def batched(items:Iterable, size:int) -> Iterator[list]:
+    """Yields lists of up to size items from items."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def payload_fingerprint(payload:dict) -> str:
+    """
+    Canonical hash of a PRH payload. Keys are sorted and keys with None values are left out,
+    so the same content always gives the same hash regardless of key order.
+    """
+    canonical = json.dumps({key: value for key, value in payload.items() if value is not None},
+                           sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def parse_shard(value:str) -> tuple[int,int]:
+    """
+    Parses a shard in format "i/N", where 0 <= i < N.
+
+    Raises:
+        ValueError: If the value is not a valid shard.
+    """
+    index, _, count = value.partition("/")
+    shard = (int(index), int(count))
+    if not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"Shard must be in format i/N with 0 <= i < N, got: '{value}'")
+    return shard
+
+def in_shard(company_number:Optional[str], shard:Optional[tuple[int,int]]) -> bool:
+    """
+    Whether the company belongs to the shard (index, count). Uses crc32 so every process agrees on the split.
+    The normalized company number is hashed, so the variants of a number (see parse_company_number) land in the same shard.
     """
-    pattern = r'^\d{7}-\d$'
-    return bool(re.match(pattern, s))
+    if shard is None:
+        return True
+    index, count = shard
+    company_number = normalize_company_number(company_number) or company_number
+    return zlib.crc32((company_number or "").encode("utf-8")) % count == index
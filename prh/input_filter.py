@@ -0,0 +1,95 @@
+from typing import Iterable, Iterator, Optional
+
+from decouple import config
+
+from prh.helpers import REJECTED_CHECK_DIGIT, REJECTED_FORMAT, batched, parse_company_number
+from prh.logging_config import REPEAT_LIMITED, my_project_logger
+from prh.metrics import metrics
+
+# Rows deduplicated together when the input is streamed. Sort a custom streamed query by company_number
+# to deduplicate all of it.
+INPUT_DEDUP_WINDOW = config("PRH_INPUT_DEDUP_WINDOW", default=10000, cast=int)
+
+
+class InputFilter:
+    """
+    Pre-fetch stage for input rows. Rows with an invalid company number (format or mod-11 check digit) are rejected
+    before they use up an API call, the accepted numbers are normalized to "1234567-8", and rows with the same
+    company number are merged into one row, so each company is fetched once.
+
+    A merged row keeps every company_uid of the company under "company_uids". Use expand_duplicates after the fetch
+    to get one fetched item per company_uid, so the company is still stored for each of them.
+    """
+
+    def __init__(self) -> None:
+        self.read = 0
+        self.accepted = 0
+        self.normalized = 0
+        self.duplicates = 0
+        self.rejected = {REJECTED_FORMAT: 0, REJECTED_CHECK_DIGIT: 0}
+
+    def clean(self, rows:Iterable[dict]) -> list[dict]:
+        """
+        Args:
+            rows (Iterable[dict]): Rows in format {company_number:str, company_uid:str}.
+
+        Returns:
+            list[dict]: One row per valid company number, in order of first appearance, in format
+                {company_number:str, company_uid:str, company_uids:list[str]}. company_uid is the first of company_uids.
+        """
+        by_number: dict[str, dict] = {}
+        for row in rows:
+            self.read += 1
+            raw_number = row.get("company_number")
+            number, rejection = parse_company_number(raw_number)
+            if rejection:
+                self.rejected[rejection] += 1
+                metrics.input_rows.inc(result=f"rejected_{rejection}")
+                my_project_logger.info("Rejected input company number: '%s', reason: %s", raw_number, rejection, extra=REPEAT_LIMITED)
+                continue
+            if number != raw_number:
+                self.normalized += 1
+                metrics.input_rows.inc(result="normalized")
+
+            uid = row.get("company_uid")
+            first = by_number.get(number)
+            if first is None:
+                self.accepted += 1
+                metrics.input_rows.inc(result="accepted")
+                by_number[number] = {"company_number":number, "company_uid":uid, "company_uids":[uid]}
+                continue
+            self.duplicates += 1
+            metrics.input_rows.inc(result="duplicate")
+            if uid not in first["company_uids"]:
+                first["company_uids"].append(uid)
+        return list(by_number.values())
+
+    def clean_stream(self, rows:Iterable[dict], window:int=INPUT_DEDUP_WINDOW) -> Iterator[dict]:
+        """Same as clean for a stream of rows. Rows are deduplicated within windows of window rows."""
+        for batch in batched(rows, window):
+            yield from self.clean(batch)
+
+    def stats(self) -> dict[str,int]:
+        return {
+            "read":self.read,
+            "accepted":self.accepted,
+            "normalized":self.normalized,
+            "duplicates":self.duplicates,
+            "rejected_format":self.rejected[REJECTED_FORMAT],
+            "rejected_check_digit":self.rejected[REJECTED_CHECK_DIGIT]
+        }
+
+
+def expand_duplicates(fetched:Optional[dict], company_uids:Optional[list[str]]) -> list[dict]:
+    """
+    Fetched item (see prh.fetch.fetch_company) once for each company_uid of a merged input row.
+
+    Args:
+        fetched (dict|None): Fetched item of the row's first company_uid, None if there was no data.
+        company_uids (list[str]|None): The row's company_uids, None for a row that didn't go through InputFilter.
+    """
+    if fetched is None:
+        return []
+    if not company_uids or len(company_uids) == 1:
+        return [fetched]
+    return [{**fetched, "company_uid":uid} for uid in company_uids]
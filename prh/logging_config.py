@@ -1,16 +1,114 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
+import time
+
+from decouple import config
 
 cwd = os.getcwd()
-filepath = os.path.join(cwd, "app.log")
+filepath = config("PRH_LOG_FILE", default=os.path.join(cwd, "app.log"))
+LOG_LEVEL = config("PRH_LOG_LEVEL", default="WARNING")
+# "text" or "json", one JSON object per line.
+LOG_FORMAT = config("PRH_LOG_FORMAT", default="text")
+# A repeat-limited message (extra=REPEAT_LIMITED) from the same call site is logged at most once in this many seconds,
+# with the number of suppressed repeats. 0 logs every repeat.
+LOG_REPEAT_INTERVAL = config("PRH_LOG_REPEAT_INTERVAL", default=10.0, cast=float)
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+
+# Pass as extra= to messages that can repeat for every company, e.g. API errors during a 429 storm.
+REPEAT_LIMITED = {"repeat_limited": True}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record:logging.LogRecord) -> str:
+        entry = {
+            "time":self.formatTime(record),
+            "level":record.levelname,
+            "logger":record.name,
+            "message":record.getMessage(),
+            "module":record.module,
+            "line":record.lineno
+        }
+        if getattr(record, "suppressed", None):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Drops repeats of a message logged with extra=REPEAT_LIMITED from the same call site within `interval` seconds.
+    With %-style arguments the call site stays the same for every company, so a flood of the same warning for
+    different company numbers is logged once per interval. The next logged repeat carries the number of dropped ones.
+    """
+
+    def __init__(self, interval:float=LOG_REPEAT_INTERVAL) -> None:
+        super().__init__()
+        self.interval = interval
+        # (pathname, lineno) -> [last logged time, suppressed count]
+        self._seen: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        if not self.interval or not getattr(record, "repeat_limited", False):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen and now - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+            suppressed = seen[1] if seen else 0
+            self._seen[key] = [now, 0]
+        if suppressed:
+            record.suppressed = suppressed
+            record.msg = f"{record.msg} (repeated {suppressed} more times)"
+        return True
+
+
+class _LocalQueueHandler(logging.handlers.QueueHandler):
+    # The queue never leaves the process, so the record only needs its message merged (the arguments could change
+    # after the call) and its traceback rendered. Formatting to the final line is left to the listener thread.
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _output_handlers() -> list[logging.Handler]:
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(), logging.FileHandler(filepath)]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
 # Configure logging (this will be the central configuration)
-logging.basicConfig(
-    level=logging.WARNING,  # Set the logging level to ERROR or any desired level
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(filepath)
-    ]
-)
+# Records are handed to a queue on the caller's thread and written to the console and the file by a listener thread,
+# so a fetch or write thread never waits for log I/O.
+log_queue: queue.Queue = queue.Queue(-1)
+queue_handler = _LocalQueueHandler(log_queue)
+queue_handler.addFilter(RepeatFilter())
+logging.basicConfig(level=LOG_LEVEL.upper(), handlers=[queue_handler])
+
+log_listener = logging.handlers.QueueListener(log_queue, *_output_handlers(), respect_handler_level=True)
+log_listener.start()
+# Flushes the records still in the queue when the process exits.
+atexit.register(log_listener.stop)
 
 my_project_logger = logging.getLogger('my_project_logger')
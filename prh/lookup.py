@@ -0,0 +1,241 @@
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Hashable, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from decouple import config
+
+from prh.fetch import fetch_company
+from prh.helpers import normalize_company_number
+from prh.logging_config import my_project_logger
+from prh.metrics import metrics
+from prh.models import Company
+from prh.pipeline import build_company
+from prh.storage import StorageBackend, open_backend
+
+LOOKUP_CACHE_SIZE = config("PRH_LOOKUP_CACHE_SIZE", default=10000, cast=int)
+LOOKUP_CACHE_TTL = config("PRH_LOOKUP_CACHE_TTL", default=300, cast=float)
+# Companies that arrive within LOOKUP_BATCH_WAIT seconds of the first one are written in one transaction,
+# at most LOOKUP_BATCH_SIZE of them.
+LOOKUP_BATCH_WAIT = config("PRH_LOOKUP_BATCH_WAIT", default=0.05, cast=float)
+LOOKUP_BATCH_SIZE = config("PRH_LOOKUP_BATCH_SIZE", default=100, cast=int)
+LOOKUP_TIMEOUT = config("PRH_LOOKUP_TIMEOUT", default=120, cast=float)
+# API requests run on this many long-lived threads. The HTTP server starts a thread per client connection, so fetching
+# on those would open a new API session and connection for every lookup.
+LOOKUP_FETCH_WORKERS = config("PRH_LOOKUP_FETCH_WORKERS", default=8, cast=int)
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ttl seconds after they were put."""
+
+    def __init__(self, max_size:int=LOOKUP_CACHE_SIZE, ttl:float=LOOKUP_CACHE_TTL) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[float, object]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key:Hashable) -> Optional[object]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key:Hashable, value:object) -> None:
+        if not self.max_size or not self.ttl:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict[str,int]:
+        with self._lock:
+            return {"entries":len(self._entries), "hits":self.hits, "misses":self.misses}
+
+
+class BatchWriter:
+    """
+    Group commit: companies submitted from many threads are written by one thread, in batches of the companies
+    that arrived within max_wait seconds of the first one. Each submit returns a future of the upload result.
+    """
+
+    def __init__(self, backend:StorageBackend, max_wait:float=LOOKUP_BATCH_WAIT, max_size:int=LOOKUP_BATCH_SIZE) -> None:
+        self.backend = backend
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, company:Company) -> Future:
+        future = Future()
+        self._queue.put((company, future))
+        return future
+
+    def close(self) -> None:
+        """Writes the companies already submitted and stops the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self) -> tuple[list, bool]:
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            batch, stopped = self._next_batch()
+            if not batch:
+                continue
+            companies = [company for company, _ in batch]
+            try:
+                with metrics.write_seconds.time(writer="lookup"):
+                    upload_results = self.backend.load(companies)
+            except Exception as e:
+                my_project_logger.error("Error writing batch of %s looked up companies, error message: %s", len(companies), e, exc_info=True)
+                upload_results = [False] * len(companies)
+            for (company, future), upload_result in zip(batch, upload_results):
+                metrics.count_upload(upload_result, company.skipped)
+                future.set_result(upload_result)
+
+
+class LookupService:
+    """
+    Resident counterpart of single.single_company. The HTTP connections to the API and the database pool stay warm
+    between lookups, recent results are served from a TTL cache, concurrent lookups of the same company share one
+    API call, and the companies of lookups that arrive close together are written in one transaction.
+    """
+
+    def __init__(self, output_uri:Optional[str]=None, cache:Optional[TTLCache]=None, fetch_workers:int=LOOKUP_FETCH_WORKERS) -> None:
+        self.backend = open_backend(output_uri)
+        self.writer = BatchWriter(self.backend)
+        # prh.fetch keeps one HTTP session per thread, these threads keep theirs warm between lookups.
+        self.fetcher = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix="lookup-fetch")
+        self.cache = cache or TTLCache()
+        self.coalesced = 0
+        self._in_flight: dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+
+    def lookup(self, company_number:str, company_uid:Optional[str]=None) -> dict:
+        """
+        Fetches a company and stores it to the output database, like single_company.
+
+        Returns:
+            dict: {"company_number", "upload_result"}, with "cached": True when served from the cache.
+        """
+        company_number = normalize_company_number(company_number) or company_number
+        key = (company_number, company_uid)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return {**cached, "cached":True}
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result(timeout=LOOKUP_TIMEOUT)
+
+        try:
+            result = self._load(company_number, company_uid)
+            if result.get("upload_result"):
+                self.cache.put(key, result)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _load(self, company_number:str, company_uid:Optional[str]) -> dict:
+        fetched = self.fetcher.submit(fetch_company, {"company_number":company_number, "company_uid":company_uid}).result(timeout=LOOKUP_TIMEOUT)
+        if not fetched:
+            return {"company_number":company_number, "upload_result":False}
+        upload_result = self.writer.submit(build_company(fetched)).result(timeout=LOOKUP_TIMEOUT)
+        return {"company_number":fetched.get("company_number"), "upload_result":upload_result}
+
+    def stats(self) -> dict[str,int]:
+        return {**self.cache.stats(), "coalesced":self.coalesced}
+
+    def close(self) -> None:
+        self.fetcher.shutdown()
+        self.writer.close()
+        self.backend.finish()
+
+
+def make_server(service:LookupService, host:str="0.0.0.0", port:int=8080) -> ThreadingHTTPServer:
+    """
+    HTTP front of a LookupService. Endpoints:
+        GET /company/<company number>[?company_uid=...]  the result of LookupService.lookup as JSON
+        GET /health                                      cache and coalescing counts
+        GET /metrics                                     the metrics in the Prometheus text format
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            parts = url.path.strip("/").split("/")
+            if parts == ["health"]:
+                self._send(200, service.stats())
+            elif parts == ["metrics"]:
+                self._send(200, metrics.prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+            elif len(parts) == 2 and parts[0] == "company":
+                company_uid = parse_qs(url.query).get("company_uid", [None])[0]
+                try:
+                    result = service.lookup(parts[1], company_uid)
+                except Exception as e:
+                    my_project_logger.error("Lookup failed for company_number: '%s', error message: %s", parts[1], e, exc_info=True)
+                    self._send(500, {"company_number":parts[1], "upload_result":False})
+                    return
+                self._send(200 if result.get("upload_result") else 404, result)
+            else:
+                self._send(404, {"message":"Not found"})
+
+        def _send(self, status:int, body:dict|str, content_type:str="application/json") -> None:
+            encoded = (body if isinstance(body, str) else json.dumps(body)).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(encoded)))
+            self.end_headers()
+            self.wfile.write(encoded)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,297 @@
+import cProfile
+import json
+import os
+import pstats
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, Optional
+
+from decouple import config
+
+from prh.logging_config import my_project_logger
+
+# Written at the end of every run when set: Prometheus text format (e.g. for node_exporter's textfile collector) and a JSON summary.
+# A "{pid}" in the path is replaced with the process id, so the shard processes of bulk.py --workers don't overwrite each other.
+METRICS_FILE = config("PRH_METRICS_FILE", default=None)
+METRICS_JSON = config("PRH_METRICS_JSON", default=None)
+# Serves /metrics on this port when set, see start_metrics_server.
+METRICS_PORT = config("PRH_METRICS_PORT", default=None, cast=lambda value: int(value) if value else None)
+# Share of companies whose fetch, transform and write are profiled with cProfile, 0 disables profiling.
+PROFILE_SAMPLE = config("PRH_PROFILE_SAMPLE", default=0.0, cast=float)
+PROFILE_DIR = config("PRH_PROFILE_DIR", default="profiles")
+
+# Histogram bucket upper bounds in seconds.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels:dict[str,str]) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key:tuple, extra:Optional[tuple]=None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name:str, help_text:str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount:float=1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def prometheus_lines(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in sorted(values.items())]
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {",".join(f"{name}={value}" for name, value in key) or "total": value for key, value in sorted(self._values.items())}
+
+
+class Gauge:
+    def __init__(self, name:str, help_text:str) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.value = 0.0
+
+    def set(self, value:float) -> None:
+        self.value = value
+
+    def prometheus_lines(self) -> list[str]:
+        return [f"{self.name} {self.value}"]
+
+    def summary(self) -> float:
+        return round(self.value, 3)
+
+
+class Histogram:
+    """Latency histogram with cumulative buckets like a Prometheus histogram."""
+
+    def __init__(self, name:str, help_text:str, buckets:tuple[float, ...]=LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        # Per label set: [bucket counts..., +Inf count], sum, count, min, max.
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds:float, **labels) -> None:
+        key = _label_key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0, seconds, seconds]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+            series[3] = min(series[3], seconds)
+            series[4] = max(series[4], seconds)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _quantile(self, bucket_counts:list[int], count:int, minimum:float, maximum:float, share:float) -> float:
+        # Linear interpolation inside the bucket like PromQL's histogram_quantile, clamped to the observed min and max.
+        rank = share * count
+        cumulative = 0
+        lower = minimum
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+            upper = min(bound, maximum)
+            if bucket_count and cumulative + bucket_count >= rank:
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower = max(lower, upper)
+        return maximum
+
+    def prometheus_lines(self) -> list[str]:
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count, _, _) in self._series.items()}
+        lines = []
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+        return lines
+
+    def summary(self) -> dict:
+        with self._lock:
+            series = {key: (list(counts), total, count, minimum, maximum) for key, (counts, total, count, minimum, maximum) in self._series.items()}
+        return {
+            ",".join(f"{name}={value}" for name, value in key) or "total": {
+                "count":count,
+                "total_seconds":round(total, 6),
+                "mean_ms":round(total / count * 1000, 3) if count else 0.0,
+                "p50_ms":round(self._quantile(counts, count, minimum, maximum, 0.50) * 1000, 3),
+                "p99_ms":round(self._quantile(counts, count, minimum, maximum, 0.99) * 1000, 3),
+                "max_ms":round(maximum * 1000, 3)
+            }
+            for key, (counts, total, count, minimum, maximum) in sorted(series.items())
+        }
+
+
+class Metrics:
+    """The metrics of the process. Use the module-level `metrics` instance."""
+
+    def __init__(self) -> None:
+        self.started = datetime.now()
+        self.fetch_seconds = Histogram("prh_fetch_seconds", "Duration of PRH API requests, rate limit wait excluded.")
+        self.rate_limit_wait_seconds = Histogram("prh_rate_limit_wait_seconds", "Time spent waiting for the API rate limiter.")
+        self.transform_seconds = Histogram("prh_transform_seconds", "Duration of building a Company from a payload.")
+        self.write_seconds = Histogram("prh_write_seconds", "Duration of database writes, per company or per batch.")
+        self.api_responses = Counter("prh_api_responses_total", "PRH API responses by HTTP status.")
+        self.api_retries = Counter("prh_api_retries_total", "Retried PRH API requests by the status that caused the retry.")
+        self.api_dropped = Counter("prh_api_dropped_total", "PRH API requests given up after the last retry, by status.")
+        self.concurrency_limit = Gauge("prh_api_concurrency_limit", "Current limit of PRH API requests in flight.")
+        self.companies = Counter("prh_companies_total", "Processed companies by result.")
+        self.input_rows = Counter("prh_input_rows_total", "Input rows by result of the pre-fetch validation and deduplication.")
+        self._all = [self.input_rows, self.fetch_seconds, self.rate_limit_wait_seconds, self.transform_seconds, self.write_seconds,
+                     self.api_responses, self.api_retries, self.api_dropped, self.concurrency_limit, self.companies]
+
+    def count_upload(self, upload_result:bool, skipped:bool) -> None:
+        self.companies.inc(result="failed" if not upload_result else "skipped" if skipped else "uploaded")
+
+    def prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._all:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            metric_type = {Histogram: "histogram", Gauge: "gauge"}.get(type(metric), "counter")
+            lines.append(f"# TYPE {metric.name} {metric_type}")
+            lines.extend(metric.prometheus_lines())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """All metrics as a JSON serializable dict, histograms with count, total, mean, p50 and p99."""
+        return {
+            "started":self.started.isoformat(),
+            "elapsed_seconds":round((datetime.now() - self.started).total_seconds(), 3),
+            **{metric.name: metric.summary() for metric in self._all}
+        }
+
+    def write_files(self, prometheus_path:Optional[str]=METRICS_FILE, json_path:Optional[str]=METRICS_JSON) -> None:
+        """Writes the Prometheus file and the JSON summary if their paths are set. Files are replaced atomically."""
+        for path, content in ((prometheus_path, self.prometheus), (json_path, lambda: json.dumps(self.summary(), indent=2))):
+            if not path:
+                continue
+            path = path.replace("{pid}", str(os.getpid()))
+            try:
+                temporary_path = f"{path}.{os.getpid()}.tmp"
+                with open(temporary_path, "w", encoding="utf-8") as file:
+                    file.write(content())
+                os.replace(temporary_path, path)
+            except OSError as e:
+                my_project_logger.error("Couldn't write metrics to %s, error message: %s", path, e)
+
+
+metrics = Metrics()
+
+
+def start_metrics_server(port:Optional[int]=METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """Serves the metrics at http://<host>:<port>/metrics in a background thread. Does nothing if port is not set."""
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.rstrip("/") != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SampledProfiler:
+    """
+    Profiles a random sample of companies with cProfile and merges the samples into one pstats file.
+    A cProfile profiler only sees the thread that enabled it, so each sample covers the thread the sampled call runs on,
+    and a call sampled while its thread is already being profiled is left to that profile.
+    """
+
+    def __init__(self, sample:float=PROFILE_SAMPLE, directory:str=PROFILE_DIR) -> None:
+        self.sample = sample
+        self.directory = directory
+        self.sampled = 0
+        self._stats: Optional[pstats.Stats] = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def maybe_profile(self) -> Iterator[None]:
+        if not self.sample or random.random() >= self.sample:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread, this call is profiled by it.
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self.sampled += 1
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+
+    def dump(self) -> Optional[str]:
+        """Writes the merged samples to <directory>/prh-<timestamp>.prof and starts a new sample. Returns the path, None if nothing was sampled."""
+        with self._lock:
+            stats, self._stats = self._stats, None
+            sampled, self.sampled = self.sampled, 0
+        if stats is None:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"prh-{datetime.now().strftime('%Y%m%dT%H%M%S%f')}.prof")
+        stats.dump_stats(path)
+        my_project_logger.warning("Wrote profile of %s sampled calls to: %s", sampled, path)
+        return path
+
+
+profiler = SampledProfiler()
+
+
+def finish_run() -> dict:
+    """Writes the metric files and the profile of the run. Returns the JSON summary."""
+    metrics.write_files()
+    profiler.dump()
+    return metrics.summary()
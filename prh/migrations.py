@@ -0,0 +1,111 @@
+from typing import Optional
+
+from sqlalchemy import Index, inspect, text
+from sqlalchemy.engine import Engine
+
+from prh.db import get_output_engine
+from prh.logging_config import my_project_logger
+from prh.models import Base, add_missing_columns
+
+# Statuses reported for each index of the models.
+INDEX_EXISTS = "exists"
+INDEX_CREATED = "created"
+INDEX_REBUILT = "rebuilt"
+INDEX_FAILED = "failed"
+
+
+def _quote(name:str) -> str:
+    return f'"{name}"'
+
+
+def model_indexes() -> list[Index]:
+    """Indexes declared in the models (index=True), in table dependency order."""
+    return [index for table in Base.metadata.sorted_tables for index in sorted(table.indexes, key=lambda index: index.name)]
+
+
+def existing_indexes(engine:Engine) -> dict[str,bool]:
+    """
+    Returns:
+        dict[str,bool]: Index name -> whether the index is valid, for every index in the current schema.
+            An index is invalid when a concurrent build of it failed or was interrupted.
+    """
+    with engine.connect() as connection:
+        result = connection.execute(text(
+            "SELECT index_class.relname, pg_index.indisvalid FROM pg_index "
+            "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+            "JOIN pg_namespace ON pg_namespace.oid = index_class.relnamespace "
+            "WHERE pg_namespace.nspname = current_schema()"
+        ))
+        return {name: valid for name, valid in result}
+
+
+def _create_index_statement(index:Index) -> str:
+    columns = ", ".join(_quote(column.name) for column in index.columns)
+    return f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {_quote(index.name)} ON {_quote(index.table.name)} ({columns})"
+
+
+def _create_indexes(engine:Engine) -> dict[str,str]:
+    # Embedded databases have no concurrent writers to keep unblocked, a plain CREATE INDEX is enough.
+    inspector = inspect(engine)
+    report = {}
+    for index in model_indexes():
+        existing = {existing_index["name"] for existing_index in inspector.get_indexes(index.table.name)}
+        if index.name in existing:
+            report[index.name] = INDEX_EXISTS
+            continue
+        index.create(engine)
+        report[index.name] = INDEX_CREATED
+    return report
+
+
+def create_indexes_concurrently(engine:Engine) -> dict[str,str]:
+    """
+    Creates the missing model indexes with CREATE INDEX CONCURRENTLY, which doesn't block writes to the table
+    while the index is built. Indexes left invalid by an earlier failed build are dropped and built again.
+    Safe to rerun, existing valid indexes are left alone. On other databases than PostgreSQL the indexes are created normally.
+
+    Returns:
+        dict[str,str]: Index name -> "exists", "created", "rebuilt" or "failed".
+    """
+    if engine.dialect.name != "postgresql":
+        return _create_indexes(engine)
+
+    existing = existing_indexes(engine)
+    report = {}
+    # CONCURRENTLY can't run inside a transaction block.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        for index in model_indexes():
+            valid: Optional[bool] = existing.get(index.name)
+            if valid:
+                report[index.name] = INDEX_EXISTS
+                continue
+            try:
+                if valid is False:
+                    my_project_logger.warning("Dropping invalid index: %s", index.name)
+                    connection.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {_quote(index.name)}"))
+                my_project_logger.warning("Creating index: %s on %s", index.name, index.table.name)
+                connection.execute(text(_create_index_statement(index)))
+                report[index.name] = INDEX_CREATED if valid is None else INDEX_REBUILT
+            except Exception as e:
+                my_project_logger.error("Error creating index: %s, error message: %s", index.name, e)
+                report[index.name] = INDEX_FAILED
+    return report
+
+
+def migrate(engine:Optional[Engine]=None) -> dict[str,str]:
+    """
+    Brings an existing output database up to the models: creates missing tables, adds missing nullable columns
+    and creates missing indexes concurrently. Can be run against a live database and rerun safely.
+
+    Args:
+        engine (Engine|None): Defaults to the output engine.
+
+    Returns:
+        dict[str,str]: Status of each model index, see create_indexes_concurrently.
+    """
+    engine = engine or get_output_engine()
+    # Only creates the tables that don't exist, existing tables are not touched.
+    Base.metadata.create_all(engine, checkfirst=True)
+    for column in add_missing_columns(engine):
+        my_project_logger.warning("Added missing column: %s", column)
+    return create_indexes_concurrently(engine)
@@ -1,15 +1,20 @@
+from collections import Counter
 from typing import Optional, Union, Tuple, Type
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, UniqueConstraint, create_engine, text
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, UniqueConstraint, delete, insert, inspect, select, text
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.exc import SQLAlchemyError
 from uuid import uuid4
 from decouple import config
 
-from prh.helpers import as_timestamp, convert_address_type, convert_version, convert_source, REGISTERED_ENTRY_AUTHORITY, REGISTERED_ENTRY_REGISTER, REGISTERED_ENTRY_STATUS
+from prh.db import get_output_engine, get_output_session
+from prh.helpers import as_timestamp, convert_address_type, convert_version, convert_source, payload_fingerprint, REGISTERED_ENTRY_AUTHORITY, REGISTERED_ENTRY_REGISTER, REGISTERED_ENTRY_STATUS
 from prh.logging_config import my_project_logger
+from prh.transform import RowExtractor, compile_row_extractor, new_pks
 
+# When True, child rows are reconciled against the existing rows instead of deleted and reinserted.
+RECONCILE_CHILD_ROWS = config("PRH_RECONCILE_CHILD_ROWS", default=False, cast=bool)
 
 Base = declarative_base()
 
@@ -17,12 +22,14 @@ class BaseCompanyModel(Base):
     __tablename__ = "company"
 
     pk = Column("pk", String, primary_key=True)
-    company_number = Column("company_number", String)
+    company_number = Column("company_number", String, index=True)
     registration_date = Column("registration_date", DateTime)
     company_form = Column("company_form", String)
     details_uri = Column("details_uri", String)
     company_name = Column("company_name", String)
-    data_fetched = Column("data_fetched", DateTime, nullable=False)
+    # Indexed for the incremental refresh, which selects the companies with the oldest data_fetched.
+    data_fetched = Column("data_fetched", DateTime, nullable=False, index=True)
+    payload_hash = Column("payload_hash", String)
 
     # __table_args__ = (
     #     UniqueConstraint("pk"),
@@ -47,7 +54,7 @@ class CompanyNameModel(Base):
     __tablename__ = "company_name"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     order = Column("order", String)
     version = Column("version", String)
@@ -79,7 +86,7 @@ class AddressModel(Base):
     __tablename__ = "address"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     version = Column("version", String)
     registration_date = Column("registration_date", DateTime)
@@ -119,7 +126,7 @@ class CompanyFormModel(Base):
     __tablename__ = "company_form"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     registration_date = Column("registration_date", DateTime)
     end_date = Column("end_date", DateTime)
@@ -151,7 +158,7 @@ class CompanyLiquidationModel(Base):
     __tablename__ = "liquidation"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     registration_date = Column("registration_date", DateTime)
     end_date = Column("end_date", DateTime)
@@ -183,7 +190,7 @@ class BusinessLineModel(Base):
     __tablename__ = "business_line"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     code = Column("code", String)
     order = Column("order", String)
@@ -217,7 +224,7 @@ class RegisteredOfficeModel(Base):
     __tablename__ = "registered_office"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     order = Column("order", Integer)
     registration_date = Column("registration_date", DateTime)
@@ -249,7 +256,7 @@ class ContactDetailModel(Base):
     __tablename__ = "contact_detail"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     version = Column("version", String)
     registration_date = Column("registration_date", DateTime)
@@ -281,7 +288,7 @@ class RegisteredEntryModel(Base):
     __tablename__ = "registered_entry"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     description = Column("description", String)
     status = Column("status", String)
     registration_date = Column("registration_date", DateTime)
@@ -313,7 +320,7 @@ class BusinessIdChangeModel(Base):
     __tablename__ = "business_id_change"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     description = Column("description", String)
     reason = Column("reason", String)
@@ -346,7 +353,7 @@ class CompanyLanguageModel(Base):
     __tablename__ = "company_language"
 
     pk = Column("pk", String, primary_key=True)
-    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False)
+    company_uid = Column("company_uid", String, ForeignKey("company.pk"), nullable=False, index=True)
     source = Column("source", String)
     version = Column("version", String)
     registration_date = Column("registration_date", DateTime)
@@ -372,6 +379,100 @@ class CompanyLanguageModel(Base):
             data_fetched = data_fetched
         )
 
+class BulkRunModel(Base):
+    __tablename__ = "bulk_run"
+
+    run_id = Column("run_id", String, primary_key=True)
+    status = Column("status", String, nullable=False)
+    shard = Column("shard", String)
+    cursor_pk = Column("cursor_pk", String)
+    started = Column("started", DateTime, nullable=False)
+    updated = Column("updated", DateTime, nullable=False)
+    finished = Column("finished", DateTime)
+
+class ChangeFeedStateModel(Base):
+    __tablename__ = "change_feed_state"
+
+    name = Column("name", String, primary_key=True)
+    # Every company registered before this date has been processed by the change feed.
+    high_water_mark = Column("high_water_mark", DateTime, nullable=False)
+    updated = Column("updated", DateTime, nullable=False)
+
+class RefreshAttemptModel(Base):
+    __tablename__ = "refresh_attempt"
+
+    # Input companies whose last incremental refresh got no data or failed, see prh.refresh.
+    company_uid = Column("company_uid", String, primary_key=True)
+    attempted = Column("attempted", DateTime, nullable=False, index=True)
+
+class BulkRunCompanyModel(Base):
+    __tablename__ = "bulk_run_company"
+
+    run_id = Column("run_id", String, ForeignKey("bulk_run.run_id"), primary_key=True)
+    company_uid = Column("company_uid", String, primary_key=True)
+    company_number = Column("company_number", String)
+    status = Column("status", String, nullable=False)
+    updated = Column("updated", DateTime, nullable=False)
+
+# Child tables in the order they are written, each referencing company.pk through company_uid.
+CHILD_MODELS: list[Type] = [
+    CompanyNameModel,
+    AddressModel,
+    CompanyFormModel,
+    CompanyLiquidationModel,
+    BusinessLineModel,
+    CompanyLanguageModel,
+    RegisteredOfficeModel,
+    ContactDetailModel,
+    RegisteredEntryModel,
+    BusinessIdChangeModel
+]
+
+# Core path of base_row and child_rows, builds plain row dicts without constructing ORM instances.
+ROW_EXTRACTORS: dict[Type, RowExtractor] = {model: compile_row_extractor(model.__table__) for model in [BaseCompanyModel] + CHILD_MODELS}
+
+# Columns that are not derived from the PRH payload and are left out of a child row's content key.
+NON_CONTENT_COLUMNS = ("pk", "company_uid", "data_fetched")
+
+def content_columns(model:Type) -> list[Column]:
+    return [column for column in model.__table__.columns if column.name not in NON_CONTENT_COLUMNS]
+
+def content_key(model:Type, row:dict) -> tuple:
+    """
+    Stable key of a child row built from the columns its from_dict fills from the PRH payload.
+    Values are compared as strings, so a datetime written to a String column matches the value read back.
+    """
+    return tuple(None if row[column.name] is None else str(row[column.name]) for column in content_columns(model))
+
+def diff_child_rows(model:Type, existing_rows:list[dict], new_rows:list[dict]) -> tuple[list[str], list[dict]]:
+    """
+    Compares the existing rows of a company to the new ones by content key.
+
+    Args:
+        model (Type): Child model of the rows.
+        existing_rows (list[dict]): Rows in the database, they must contain "pk" and the content columns.
+        new_rows (list[dict]): Rows created from the latest payload.
+
+    Returns:
+        tuple[list[str], list[dict]]: pks of the existing rows to delete and the new rows to insert. Unchanged rows keep their pk.
+    """
+    unmatched = Counter(content_key(model, row) for row in new_rows)
+    delete_pks = []
+    for row in existing_rows:
+        key = content_key(model, row)
+        if unmatched[key] > 0:
+            unmatched[key] -= 1
+        else:
+            delete_pks.append(row["pk"])
+
+    insert_rows = []
+    for row in new_rows:
+        key = content_key(model, row)
+        if unmatched[key] > 0:
+            unmatched[key] -= 1
+            insert_rows.append(row)
+    return delete_pks, insert_rows
+
 class Company:
     def __init__(self,
                  names: Optional[list]=None,
@@ -397,6 +498,17 @@ class Company:
         self.company_uid: str = str(uuid4()) if not company_uid else company_uid
         self.data_fetched: datetime = datetime.now()
         self.company_number: Optional[str] = businessId
+        # Set by the writers when the stored payload hash matched and the child rows were not written.
+        self.skipped: bool = False
+        # Replays set this to False, the rows must be rewritten when the mapping changed even if the payload didn't.
+        self.skip_unchanged: bool = True
+        self.payload_hash: str = payload_fingerprint({
+            "names":names, "auxiliaryNames":auxiliaryNames, "addresses":addresses, "companyForms":companyForms,
+            "liquidations":liquidations, "businessLines":businessLines, "languages":languages,
+            "registeredOffices":registeredOffices, "contactDetails":contactDetails, "registeredEntries":registeredEntries,
+            "businessIdChanges":businessIdChanges, "businessId":businessId, "registrationDate":registrationDate,
+            "companyForm":companyForm, "detailsUri":detailsUri, "name":name, **kwargs
+        })
 
         self.names = names
         self.auxiliary_names = auxiliaryNames
@@ -433,21 +545,15 @@ class Company:
 
         # Logging the extra key-value pairs that was passed to this class.
         if kwargs:
-            my_project_logger.info(f"Extra arguments passed to class: {self.__class__.__name__}, extra arguments: {kwargs}, happened with company: {self.company_uid}")
+            my_project_logger.info("Extra arguments passed to class: %s, extra arguments: %s, happened with company: %s", self.__class__.__name__, kwargs, self.company_uid)
         
     @staticmethod
     def _create_session():
-        output_db_uri = config("POSTGRES_OUTPUT_DB")
-        engine = create_engine(output_db_uri)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-
+        # The shared engine checks connections with pre-ping on checkout, so no probe query is needed here.
         try:
-            session.execute(text("SELECT 1"))
-            return session
+            return get_output_session()
         except Exception as e:
-            my_project_logger.error(f"Error creating a session to postgre:{output_db_uri}, message: {str(e)}")
-            session.close()
+            my_project_logger.error("Error creating a session to postgre, message: %s", e)
             return False
      
     def _create_model_instance_list(self,
@@ -487,6 +593,34 @@ class Company:
 
         return model_list
 
+    def _base_instance(self) -> BaseCompanyModel:
+        base_instance = self._create_model_instance_list(BaseCompanyModel, self.base_company)
+        base_instance.payload_hash = self.payload_hash
+        return base_instance
+
+    def base_row(self) -> dict:
+        """The company table row as a column name -> value dict."""
+        row = ROW_EXTRACTORS[BaseCompanyModel](self.company_uid, self.company_uid, self.data_fetched, self.base_company)
+        row["payload_hash"] = self.payload_hash
+        return row
+
+    def child_rows(self) -> dict[Type, list[dict]]:
+        """
+        Rows of the child tables grouped by model, as column name -> value dicts. Models without rows are left out.
+        The rows are built with the precompiled extractors of prh.transform, not through ORM instances.
+        """
+        rows_by_model: dict[Type, list[dict]] = {}
+        for attribute, model in self.attribute_model_pairs:
+            # Empty entries are left out, from_dict would make a row without a pk of them.
+            entries = [entry for entry in attribute if entry] if attribute else None
+            if not entries:
+                continue
+            extract = ROW_EXTRACTORS[model]
+            rows = rows_by_model.setdefault(model, [])
+            for pk, entry in zip(new_pks(len(entries)), entries):
+                rows.append(extract(pk, self.company_uid, self.data_fetched, entry))
+        return rows_by_model
+
     def to_postgres(self) -> bool:
         session = self._create_session()
         if session is False:
@@ -508,7 +642,7 @@ class Company:
 
         try:
             # Need to commit the BaseCompanyModel data first due to FK constraints.
-            base_instance = self._create_model_instance_list(model=BaseCompanyModel, data=self.base_company)
+            base_instance = self._base_instance()
             session.add(base_instance)
             session.commit()
 
@@ -522,7 +656,7 @@ class Company:
             return True
         
         except SQLAlchemyError as e:
-            my_project_logger.error(f"Error committing models to PostgreSQL, company_uid: {self.company_uid}, company number: {self.company_number}, error message: {str(e)}")
+            my_project_logger.error("Error committing models to PostgreSQL, company_uid: %s, company number: %s, error message: %s", self.company_uid, self.company_number, e)
             session.rollback()
             return False
         
@@ -542,44 +676,101 @@ class Company:
 
             session.add_all(instance_list)
 
-    def update_postgres(self) -> bool:
+    def _reconcile_rows(self, session):
+        # Unlike _update_rows every child table is compared, so rows removed from the payload are deleted too.
+        rows_by_model = self.child_rows()
+        for model in CHILD_MODELS:
+            table = model.__table__
+            existing_rows = session.execute(
+                select(table.c.pk, *content_columns(model)).where(table.c.company_uid == self.company_uid)
+            ).mappings().all()
+
+            delete_pks, insert_rows = diff_child_rows(model, existing_rows, rows_by_model.get(model, []))
+            if delete_pks:
+                session.execute(delete(table).where(table.c.pk.in_(delete_pks)))
+            if insert_rows:
+                session.execute(insert(table), insert_rows)
+
+    def update_postgres(self, reconcile:Optional[bool]=None) -> bool:
+        """
+        Upserts the company and updates its child rows.
+        If the stored payload hash equals this payload's hash only data_fetched is updated and self.skipped is set.
+
+        Args:
+            reconcile (bool|None): If True only the child rows that were added or removed are written, see diff_child_rows.
+                Defaults to PRH_RECONCILE_CHILD_ROWS.
+        """
+        if reconcile is None:
+            reconcile = RECONCILE_CHILD_ROWS
+
         session = self._create_session()
         if session is False:
             return False
         
         try:
-            base_instance = self._create_model_instance_list(BaseCompanyModel, self.base_company)
+            base_instance = self._base_instance()
             existing_row = session.query(BaseCompanyModel).filter_by(pk=self.company_uid).first()
             if not base_instance:
                 return False
+
+            if self.skip_unchanged and existing_row and existing_row.payload_hash == self.payload_hash:
+                existing_row.data_fetched = self.data_fetched
+                session.commit()
+                self.skipped = True
+                return True
             
+            # The base row, its payload_hash included, is committed together with the child rows. Committed on its own,
+            # a failed child write would leave a matching hash behind and later runs would skip the company.
             if existing_row:
                 session.merge(base_instance)
-                session.commit()
             else:
                 session.add(base_instance)
-                session.commit()
-            
+            session.flush()
 
-            self._update_rows(session)
+            if reconcile:
+                self._reconcile_rows(session)
+            else:
+                self._update_rows(session)
 
             session.commit()
             return True
 
         except Exception as e:
-            my_project_logger.error(f"Error committing models to PostgreSQL, company_uid: {self.company_uid}, company number: {self.company_number}, error message: {str(e)}")
+            my_project_logger.error("Error committing models to PostgreSQL, company_uid: %s, company number: %s, error message: %s", self.company_uid, self.company_number, e)
             session.rollback()
             return False
         
         finally:
             session.close()
 
-def create_tables():
-    address_p = config("POSTGRES_OUTPUT_DB")
-    engine = create_engine(address_p)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def add_missing_columns(engine) -> list[str]:
+    """
+    Adds the model columns that are missing from existing tables, create_all only creates missing tables.
+    Only nullable columns can be added this way.
+
+    Returns:
+        list[str]: Added columns in format "table.column".
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    added = []
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                added.append(f"{table.name}.{column.name}")
+    return added
+
+def create_tables(engine=None):
+    engine = engine or get_output_engine()
     Base.metadata.create_all(engine)
-    session.commit()
-    session.close()
+    for column in add_missing_columns(engine):
+        my_project_logger.warning("Added missing column: %s", column)
+    # create_all only creates the indexes of new tables, migrate.py creates the missing ones without blocking writes.
 
@@ -0,0 +1,171 @@
+import os
+import threading
+from datetime import date, datetime
+from typing import Optional
+
+from decouple import config
+from sqlalchemy import DateTime, Integer, Table
+
+from prh.logging_config import my_project_logger
+from prh.models import CHILD_MODELS, BaseCompanyModel, Company
+
+# pyarrow is only needed for the Parquet sink, so it is not a hard requirement.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+PARQUET_BATCH_SIZE = config("PRH_PARQUET_BATCH_SIZE", default=5000, cast=int)
+# A file is closed and a new one started after this many rows of a table.
+PARQUET_FILE_ROWS = config("PRH_PARQUET_FILE_ROWS", default=1_000_000, cast=int)
+PARQUET_COMPRESSION = config("PRH_PARQUET_COMPRESSION", default="zstd")
+# Files are written under this suffix and renamed when closed, so readers never see a file without its footer.
+IN_PROGRESS_SUFFIX = ".inprogress"
+
+
+def _arrow_type(column):
+    if isinstance(column.type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    return pa.string()
+
+
+def arrow_schema(table:Table):
+    """Arrow schema matching the columns of a model table."""
+    return pa.schema([pa.field(column.name, _arrow_type(column), nullable=column.nullable) for column in table.columns])
+
+
+def _as_string(value) -> Optional[str]:
+    # Some String columns get ints or datetimes from the payload, PostgreSQL stores them as their str().
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+def _as_int(value) -> Optional[int]:
+    return None if value is None else int(value)
+
+
+def _converter(column):
+    """Converts the row values of a column to the Python type of its Arrow type, None if they already are."""
+    if isinstance(column.type, DateTime):
+        return None
+    if isinstance(column.type, Integer):
+        return _as_int
+    return _as_string
+
+
+class _RollingFile:
+    def __init__(self, path:str, schema) -> None:
+        self.path = path
+        self.rows = 0
+        self._writer = pq.ParquetWriter(path + IN_PROGRESS_SUFFIX, schema, compression=PARQUET_COMPRESSION)
+
+    def write(self, batch) -> None:
+        self._writer.write_batch(batch)
+        self.rows += batch.num_rows
+
+    def close(self) -> None:
+        self._writer.close()
+        os.replace(self.path + IN_PROGRESS_SUFFIX, self.path)
+
+
+class ParquetSink:
+    """
+    Writes companies to Parquet files instead of PostgreSQL, one dataset per output table.
+    Files are partitioned by the day the data was fetched:
+
+        <directory>/<table>/fetched_date=YYYY-MM-DD/part-<run id>-<index>.parquet
+
+    Every load() call appends one Arrow record batch per table, built column by column from the rows of
+    Company.base_row and Company.child_rows. A file is finished and a new one started after file_rows rows.
+    Call finish() at the end so that the last files get their footer.
+
+    Example:
+        sink = ParquetSink("/data/prh")
+        for batch in batches:
+            sink.load(batch)
+        sink.finish()
+    """
+
+    def __init__(self, directory:str, file_rows:int=PARQUET_FILE_ROWS) -> None:
+        if pa is None:
+            raise ImportError("The Parquet sink needs pyarrow, install it with: pip install pyarrow")
+        self.directory = directory
+        self.file_rows = file_rows
+        self.tables: list[Table] = [model.__table__ for model in [BaseCompanyModel] + CHILD_MODELS]
+        self._schemas = {table.name: arrow_schema(table) for table in self.tables}
+        self._converters = {table.name: [(column.name, _converter(column)) for column in table.columns] for table in self.tables}
+        self._run_id = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        self._file_index = 0
+        self._files: dict[tuple[str, date], _RollingFile] = {}
+        self._lock = threading.Lock()
+
+    def _record_batch(self, table_name:str, rows:list[dict]):
+        arrays = []
+        for column, converter in self._converters[table_name]:
+            values = [row[column] for row in rows]
+            if converter is not None:
+                values = [converter(value) for value in values]
+            arrays.append(values)
+        return pa.RecordBatch.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(arrays, self._schemas[table_name])],
+            schema=self._schemas[table_name]
+        )
+
+    def _file(self, table_name:str, fetched_date:date) -> _RollingFile:
+        key = (table_name, fetched_date)
+        current = self._files.get(key)
+        if current is not None and current.rows >= self.file_rows:
+            current.close()
+            current = None
+        if current is None:
+            partition = os.path.join(self.directory, table_name, f"fetched_date={fetched_date.isoformat()}")
+            os.makedirs(partition, exist_ok=True)
+            current = _RollingFile(os.path.join(partition, f"part-{self._run_id}-{self._file_index:06d}.parquet"), self._schemas[table_name])
+            self._file_index += 1
+            self._files[key] = current
+        return current
+
+    def load(self, companies:list[Company]) -> list[bool]:
+        """
+        Appends a batch of companies to the current files.
+
+        Returns:
+            list[bool]: Upload result for each company, in the same order as companies.
+        """
+        if not companies:
+            return []
+
+        rows_by_partition: dict[tuple[str, date], list[dict]] = {}
+        try:
+            for company in companies:
+                fetched_date = company.data_fetched.date()
+                rows_by_partition.setdefault((BaseCompanyModel.__tablename__, fetched_date), []).append(company.base_row())
+                for model, rows in company.child_rows().items():
+                    rows_by_partition.setdefault((model.__tablename__, fetched_date), []).extend(rows)
+
+            batches = {key: self._record_batch(key[0], rows) for key, rows in rows_by_partition.items()}
+            with self._lock:
+                for (table_name, fetched_date), batch in batches.items():
+                    self._file(table_name, fetched_date).write(batch)
+            return [True] * len(companies)
+
+        except Exception as e:
+            my_project_logger.error("Error writing batch of %s companies to Parquet, error message: %s", len(companies), e)
+            return [False] * len(companies)
+
+    def finish(self) -> bool:
+        """Closes the open files. Returns False if any of them couldn't be closed."""
+        success = True
+        with self._lock:
+            for file in self._files.values():
+                try:
+                    file.close()
+                except Exception as e:
+                    my_project_logger.error("Error closing Parquet file: %s, error message: %s", file.path, e)
+                    success = False
+            self._files = {}
+        return success
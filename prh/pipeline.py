@@ -0,0 +1,209 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+from decouple import config
+
+from prh.archive import ArchiveWriter
+from prh.fetch import fetch_company
+from prh.input_filter import expand_duplicates
+from prh.logging_config import my_project_logger
+from prh.metrics import metrics, profiler
+from prh.models import Company
+from prh.writers import update_postgres_batch
+
+PIPELINE_QUEUE_SIZE = config("PRH_PIPELINE_QUEUE_SIZE", default=100, cast=int)
+PIPELINE_FETCH_WORKERS = config("PRH_PIPELINE_FETCH_WORKERS", default=4, cast=int)
+# A batch that is not full is written PIPELINE_BATCH_WAIT seconds after its first company arrived,
+# so uploads don't wait for batch_size companies to be fetched.
+PIPELINE_BATCH_WAIT = config("PRH_PIPELINE_BATCH_WAIT", default=5, cast=float)
+
+# Marks the end of a stage's output. Each worker of a stage puts one when it stops.
+_DONE = object()
+
+
+def _put_all(rows:Iterable, out_queue:queue.Queue, consumers:int) -> None:
+    try:
+        for row in rows:
+            out_queue.put(row)
+    except Exception as e:
+        my_project_logger.error("Pipeline input stage failed, error message: %s", e, exc_info=True)
+    finally:
+        for _ in range(consumers):
+            out_queue.put(_DONE)
+
+
+def _map_stage(func:Callable, in_queue:queue.Queue, out_queue:queue.Queue, producers:int=1, many:bool=False) -> None:
+    """
+    Applies func to each item of in_queue, skipping None results. With many, func returns a list of results.
+    Stops after receiving a _DONE from each of the producers and then puts one _DONE of its own.
+    """
+    try:
+        while producers:
+            item = in_queue.get()
+            if item is _DONE:
+                producers -= 1
+                continue
+            try:
+                result = func(item)
+            except Exception as e:
+                my_project_logger.error("Pipeline stage %s failed for item: %s, error message: %s", func.__name__, item.get('company_number'), e, exc_info=True)
+                continue
+            for result in (result if many else [result]):
+                if result is not None:
+                    out_queue.put(result)
+    finally:
+        out_queue.put(_DONE)
+
+
+def _timed_batches(items:Iterable, batch_size:int, max_wait:float) -> Iterator[list]:
+    """
+    Groups items into lists of at most batch_size. A list is yielded when it is full or max_wait seconds after its first item arrived.
+    The items are read in a thread of their own, an exception raised while reading them is raised again after the last list.
+    """
+    items_queue = queue.Queue(maxsize=batch_size)
+    errors = []
+
+    def read() -> None:
+        try:
+            for item in items:
+                items_queue.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items_queue.put(_DONE)
+
+    _start(read)
+    done = False
+    while not done:
+        first = items_queue.get()
+        if first is _DONE:
+            break
+        batch = [first]
+        deadline = time.monotonic() + max_wait
+        while len(batch) < batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = items_queue.get(timeout=remaining) if remaining > 0 else items_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                done = True
+                break
+            batch.append(item)
+        yield batch
+    if errors:
+        raise errors[0]
+
+
+def build_company(fetched:dict) -> Company:
+    """Builds the Company of a fetched item (see prh.fetch.fetch_company), timed as the transform stage."""
+    with metrics.transform_seconds.time(), profiler.maybe_profile():
+        return Company(company_uid=fetched.get("company_uid"), **fetched.get("data"))
+
+
+def _transform(fetched:dict) -> tuple[str, Company]:
+    return fetched.get("company_number"), build_company(fetched)
+
+
+def _result(company_number:str, company:Company, upload_result:bool) -> dict[str,str|bool]:
+    metrics.count_upload(upload_result, company.skipped)
+    return {"company_number":company_number, "company_uid":company.company_uid, "upload_result":upload_result, "skipped":company.skipped}
+
+
+def _start(target:Callable, *args) -> threading.Thread:
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def stream_companies(input_rows:Iterable[dict[str,str]],
+                     fetch_workers:Optional[int]=None,
+                     queue_size:Optional[int]=None,
+                     archive:Optional[ArchiveWriter]=None) -> Iterator[tuple[str, Company]]:
+    """
+    Streams input rows through the fetch and transform stages.
+    Each stage runs in its own thread(s) and the stages are connected with bounded queues,
+    so at most a few queue_size items are held in memory at any time regardless of the input size.
+
+    Args:
+        input_rows (Iterable[dict[str,str]]): Rows in format {company_number:str, company_uid:str}. May be a generator.
+        fetch_workers (int|None): Number of threads doing API requests. They share the API rate limiter. Defaults to PRH_PIPELINE_FETCH_WORKERS.
+        queue_size (int|None): Maximum number of items between two stages. Defaults to PRH_PIPELINE_QUEUE_SIZE.
+        archive (ArchiveWriter|None): If given, every fetched payload is also written to this raw response archive.
+
+    Yields:
+        tuple[str, Company]: Company number and the transformed Company, in completion order.
+            Rows merged by prh.input_filter.InputFilter give one Company per company_uid.
+    """
+    fetch_workers = fetch_workers or PIPELINE_FETCH_WORKERS
+    queue_size = queue_size or PIPELINE_QUEUE_SIZE
+
+    input_queue = queue.Queue(maxsize=queue_size)
+    fetched_queue = queue.Queue(maxsize=queue_size)
+    transformed_queue = queue.Queue(maxsize=queue_size)
+
+    def fetch(item:dict) -> list[dict]:
+        return expand_duplicates(fetch_company(item, archive), item.get("company_uids"))
+
+    _start(_put_all, input_rows, input_queue, fetch_workers)
+    for _ in range(fetch_workers):
+        _start(_map_stage, fetch, input_queue, fetched_queue, 1, True)
+    _start(_map_stage, _transform, fetched_queue, transformed_queue, fetch_workers)
+
+    while True:
+        item = transformed_queue.get()
+        if item is _DONE:
+            return
+        yield item
+
+
+def upload_companies(companies:Iterable[tuple[str, Company]],
+                     batch_size:Optional[int]=None,
+                     batch_writer:Optional[Callable[[list[Company]], list[bool]]]=None,
+                     max_wait:Optional[float]=None) -> Iterator[dict[str,str|bool]]:
+    """
+    Uploads companies one at a time with update_postgres, or batch_size at a time with batch_writer.
+
+    Args:
+        companies (Iterable[tuple[str, Company]]): Company numbers and companies. May be a generator.
+        batch_size (int|None): If given, companies are written batch_size at a time with batch_writer.
+        batch_writer (Callable|None): Writes a list of companies and returns their upload results. Defaults to update_postgres_batch.
+        max_wait (float|None): A batch that is not full is written max_wait seconds after its first company arrived. Defaults to PRH_PIPELINE_BATCH_WAIT.
+
+    Yields:
+        dict[str,str|bool]: {"company_number", "company_uid", "upload_result", "skipped"} for each uploaded company.
+    """
+    if not batch_size:
+        for company_number, company in companies:
+            with metrics.write_seconds.time(writer="company"), profiler.maybe_profile():
+                upload_result = company.update_postgres()
+            yield _result(company_number, company, upload_result)
+        return
+
+    batch_writer = batch_writer or update_postgres_batch
+    max_wait = PIPELINE_BATCH_WAIT if max_wait is None else max_wait
+    for batch in _timed_batches(companies, batch_size, max_wait):
+        with metrics.write_seconds.time(writer="batch"):
+            upload_results = batch_writer([company for _, company in batch])
+        for (company_number, company), upload_result in zip(batch, upload_results):
+            yield _result(company_number, company, upload_result)
+
+
+def stream_upload(input_rows:Iterable[dict[str,str]],
+                  fetch_workers:Optional[int]=None,
+                  queue_size:Optional[int]=None,
+                  batch_size:Optional[int]=None,
+                  batch_writer:Optional[Callable[[list[Company]], list[bool]]]=None,
+                  archive:Optional[ArchiveWriter]=None) -> Iterator[dict[str,str|bool]]:
+    """
+    End-to-end streaming run: input rows -> fetch -> transform -> upload.
+    Uploads start as soon as the first company has been fetched, or with batch_size at most PRH_PIPELINE_BATCH_WAIT seconds later.
+    See stream_companies and upload_companies for the arguments.
+
+    Yields:
+        dict[str,str|bool]: {"company_number", "company_uid", "upload_result", "skipped"} for each uploaded company.
+    """
+    companies = stream_companies(input_rows, fetch_workers, queue_size, archive)
+    yield from upload_companies(companies, batch_size, batch_writer)
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import sqlite3
+import time
+
+from decouple import config
+
+from prh.logging_config import my_project_logger
+
+RATE_LIMIT_CALLS = config("PRH_RATE_LIMIT_CALLS", default=290, cast=int)
+RATE_LIMIT_PERIOD = config("PRH_RATE_LIMIT_PERIOD", default=60, cast=float)
+RATE_LIMIT_BURST = config("PRH_RATE_LIMIT_BURST", default=10, cast=int)
+RATE_LIMIT_DB = config("PRH_RATE_LIMIT_DB", default=os.path.join(os.getcwd(), "ratelimit.db"))
+
+
+class TokenBucket:
+    """
+    Token bucket whose state lives in a SQLite file, so every process pointing at the same file
+    (bulk.py, concurrent single.py runs, worker processes) draws from one shared budget.
+    Each call to acquire() takes one token and blocks until one is available.
+
+    At most `burst` tokens are stored and they refill at (calls - burst)/period per second, so the stored burst
+    is part of the budget and in any window of `period` seconds no more than calls requests are made.
+    """
+
+    def __init__(self, name:str="prh_api", calls:int=RATE_LIMIT_CALLS, period:float=RATE_LIMIT_PERIOD,
+                 burst:int=RATE_LIMIT_BURST, db_path:str=RATE_LIMIT_DB) -> None:
+        self.name = name
+        self.burst = max(1, min(burst, calls - 1))
+        self.rate = max(1, calls - self.burst) / period
+        self.db_path = db_path
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # A short lived connection per call keeps the bucket safe to use after fork and from any thread.
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        if not self._initialized:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS token_bucket (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._initialized = True
+        return connection
+
+    def _try_take(self) -> tuple[bool,float]:
+        """Takes a token if one is available. Returns whether a token was taken and the seconds to wait before going on."""
+        connection = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the database write lock, serializing the read-modify-write between processes.
+            connection.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            row = connection.execute("SELECT tokens, updated_at FROM token_bucket WHERE name = ?", (self.name,)).fetchone()
+            if row is None:
+                tokens = float(self.burst)
+            else:
+                tokens = min(float(self.burst), row[0] + (now - row[1]) * self.rate)
+
+            taken = tokens >= 1
+            if taken:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate
+
+            connection.execute(
+                "INSERT INTO token_bucket (name, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (self.name, tokens, now)
+            )
+            connection.execute("COMMIT")
+            return taken, wait
+        except sqlite3.Error as e:
+            my_project_logger.error("Rate limiter state unavailable at %s, error message: %s", self.db_path, e)
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            # Fall back to pacing this process alone rather than stopping the run.
+            return True, 1 / self.rate
+        finally:
+            connection.close()
+
+    def acquire(self) -> float:
+        """Blocks until a token is taken. Returns the total seconds spent waiting."""
+        waited = 0.0
+        while True:
+            taken, wait = self._try_take()
+            if wait:
+                time.sleep(wait)
+                waited += wait
+            if taken:
+                return waited
+
+    async def acquire_async(self) -> float:
+        """Same as acquire but yields to the event loop while waiting. The SQLite state is read in a worker thread."""
+        waited = 0.0
+        while True:
+            taken, wait = await asyncio.to_thread(self._try_take)
+            if wait:
+                await asyncio.sleep(wait)
+                waited += wait
+            if taken:
+                return waited
+
+
+api_rate_limiter = TokenBucket()
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+from typing import Optional
+
+from decouple import config
+from sqlalchemy import delete, insert, literal_column, select, union_all
+
+from prh.db import get_output_engine, get_output_session
+from prh.fetch import iter_company_nums, query_company_nums_by_uid
+from prh.helpers import batched, normalize_company_number
+from prh.models import BaseCompanyModel, RefreshAttemptModel
+from prh.rate_limit import RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD
+
+REFRESH_MAX_AGE_DAYS = config("PRH_REFRESH_MAX_AGE_DAYS", default=30, cast=float)
+REFRESH_WINDOW = config("PRH_REFRESH_WINDOW", default=60 * 60, cast=float)
+# Number of company_uids looked up in the other database per query.
+REFRESH_CHUNK_SIZE = config("PRH_REFRESH_CHUNK_SIZE", default=500, cast=int)
+
+
+def refresh_limit(window_seconds:float=REFRESH_WINDOW) -> int:
+    """Number of API calls the rate limit allows in window_seconds."""
+    return int(RATE_LIMIT_CALLS * window_seconds / RATE_LIMIT_PERIOD)
+
+
+def _never_fetched_rows(query_statement, limit:int, chunk_size:int) -> list[dict]:
+    # Streams the input and asks the output database which uids of each chunk it already has or has tried to fetch.
+    # Rows with an invalid company number are left out, InputFilter would reject them every round.
+    company = BaseCompanyModel.__table__
+    attempt = RefreshAttemptModel.__table__
+    never_fetched = []
+    with get_output_engine().connect() as connection:
+        for chunk in batched(iter_company_nums(query_statement), chunk_size):
+            chunk = [row for row in chunk if normalize_company_number(row.get("company_number"))]
+            uids = [row.get("company_uid") for row in chunk]
+            if not uids:
+                continue
+            known_uids = set(connection.execute(union_all(
+                select(company.c.pk).where(company.c.pk.in_(uids), company.c.data_fetched.is_not(None)),
+                select(attempt.c.company_uid).where(attempt.c.company_uid.in_(uids))
+            )).scalars())
+            never_fetched.extend(row for row in chunk if row.get("company_uid") not in known_uids)
+            if len(never_fetched) >= limit:
+                return never_fetched[:limit]
+    return never_fetched
+
+
+def _stale_uids_query(cutoff:datetime):
+    # Stored companies age from data_fetched, unless a later refresh of theirs failed within max_age. Companies that
+    # were never stored age from their last failed attempt. Both sides are read through their index on the time.
+    company = BaseCompanyModel.__table__
+    attempt = RefreshAttemptModel.__table__
+    stored = (
+        select(company.c.pk.label("company_uid"), company.c.data_fetched.label("aged_from"))
+        .select_from(company.outerjoin(attempt, attempt.c.company_uid == company.c.pk))
+        .where(company.c.data_fetched < cutoff, (attempt.c.attempted.is_(None)) | (attempt.c.attempted < cutoff))
+    )
+    missed = (
+        select(attempt.c.company_uid, attempt.c.attempted.label("aged_from"))
+        .select_from(attempt.outerjoin(company, company.c.pk == attempt.c.company_uid))
+        .where(company.c.pk.is_(None), attempt.c.attempted < cutoff)
+    )
+    return union_all(stored, missed).order_by(literal_column("aged_from"))
+
+
+def _stale_rows(query_statement, cutoff:datetime, limit:int, chunk_size:int) -> list[dict]:
+    # Reads the stale uids oldest first and keeps the ones still in the input.
+    stale = []
+    with get_output_engine().connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(_stale_uids_query(cutoff))
+        for uids in batched(result.scalars(), chunk_size):
+            stale.extend(query_company_nums_by_uid(uids, query_statement))
+            if len(stale) >= limit:
+                return stale[:limit]
+    return stale
+
+
+def select_stale_company_nums(max_age:timedelta=timedelta(days=REFRESH_MAX_AGE_DAYS),
+                              limit:Optional[int]=None,
+                              query_statement=None,
+                              chunk_size:int=REFRESH_CHUNK_SIZE) -> list[dict]:
+    """
+    Selects the input companies whose data in the output database is older than max_age, oldest first.
+    Companies that have never been fetched come before all others.
+
+    A company whose refresh got no data or failed is recorded with the time of the attempt (see record_refresh_attempts)
+    and is not selected again before the attempt is older than max_age, so misses don't use up every round.
+    Rows with an invalid company number are never selected.
+
+    The input and output databases can be on different servers, so the join is done here, chunk_size company_uids at a time:
+    the input rows are streamed and checked against the output database for companies that were never fetched, then the
+    stale company_uids are streamed from the output database in the order of the index on company.data_fetched and looked
+    up in the input. Both stop once limit rows are found, so at most limit rows and one chunk are held in memory.
+
+    Args:
+        max_age (timedelta): Companies fetched or attempted more recently than this are left out.
+        limit (int|None): Maximum number of companies to return. Defaults to refresh_limit().
+        query_statement (): Input query, same as in bulk_run. Defaults to the default input query.
+        chunk_size (int): Number of company_uids looked up per query.
+
+    Returns:
+        list[dict]: Rows in format {company_number:str, company_uid:str}.
+    """
+    limit = refresh_limit() if limit is None else limit
+    if limit <= 0:
+        return []
+    never_fetched = _never_fetched_rows(query_statement, limit, chunk_size)
+    if len(never_fetched) >= limit:
+        return never_fetched
+    return never_fetched + _stale_rows(query_statement, datetime.now() - max_age, limit - len(never_fetched), chunk_size)
+
+
+def record_refresh_attempts(input_rows:list[dict], upload_results:list[dict]) -> None:
+    """
+    Records the time of the attempt for the input rows that weren't uploaded, and clears it for the ones that were.
+
+    Args:
+        input_rows (list[dict]): Rows selected by select_stale_company_nums.
+        upload_results (list[dict]): Upload results of the round, see bulk_run.
+    """
+    uploaded = {result.get("company_uid") for result in upload_results if result.get("upload_result")}
+    uids = list(dict.fromkeys(row.get("company_uid") for row in input_rows))
+    now = datetime.now()
+    attempt = RefreshAttemptModel.__table__
+    with get_output_session() as session:
+        for chunk in batched(uids, REFRESH_CHUNK_SIZE):
+            session.execute(delete(attempt).where(attempt.c.company_uid.in_(chunk)))
+            missed = [{"company_uid": uid, "attempted": now} for uid in chunk if uid not in uploaded]
+            if missed:
+                session.execute(insert(attempt), missed)
+        session.commit()
@@ -0,0 +1,163 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Iterator, Optional
+
+from decouple import config
+
+from prh.metrics import metrics
+
+RETRY_ATTEMPTS = config("PRH_RETRY_ATTEMPTS", default=4, cast=int)
+RETRY_BASE_DELAY = config("PRH_RETRY_BASE_DELAY", default=1.0, cast=float)
+RETRY_MAX_DELAY = config("PRH_RETRY_MAX_DELAY", default=60.0, cast=float)
+CONCURRENCY_INITIAL = config("PRH_CONCURRENCY_INITIAL", default=4, cast=int)
+CONCURRENCY_MAX = config("PRH_CONCURRENCY_MAX", default=32, cast=int)
+# The limit is cut at most once in this many seconds, so a burst of 429s answered to requests that were
+# already in flight counts as one congestion signal.
+CONCURRENCY_DECREASE_INTERVAL = config("PRH_CONCURRENCY_DECREASE_INTERVAL", default=1.0, cast=float)
+
+# Statuses worth retrying. 429 and 503 also mean the API is overloaded and cut the concurrency limit.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+THROTTLE_STATUSES = frozenset({429, 503})
+# Status used for connection errors and timeouts, which are retried like 5xx responses.
+CONNECTION_ERROR = 0
+
+
+def parse_retry_after(value:Optional[str]) -> Optional[float]:
+    """
+    Args:
+        value (str|None): Retry-After header, either seconds or an HTTP date.
+
+    Returns:
+        float|None: Seconds to wait, None if the header is missing or invalid.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryController:
+    """
+    Retries and concurrency control for the PRH API, shared by all fetch threads and coroutines of a process.
+
+    Retryable responses (RETRY_STATUSES and connection errors) are retried up to `attempts` times. The wait before a
+    retry is the Retry-After of the response when given, otherwise a jittered exponential backoff ("full jitter":
+    uniform between 0 and base_delay * 2**attempt, capped at max_delay).
+
+    The number of requests in flight is limited AIMD-style: every successful response raises the limit by 1/limit,
+    about one more request per round trip, and a 429 or 503 halves it. The limit stays between 1 and max_concurrency.
+    The token bucket in prh.rate_limit still caps the request rate, this keeps the concurrency at what the API can take.
+    """
+
+    def __init__(self, attempts:int=RETRY_ATTEMPTS, base_delay:float=RETRY_BASE_DELAY, max_delay:float=RETRY_MAX_DELAY,
+                 initial_concurrency:int=CONCURRENCY_INITIAL, max_concurrency:int=CONCURRENCY_MAX,
+                 decrease_interval:float=CONCURRENCY_DECREASE_INTERVAL) -> None:
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(min(max(1, initial_concurrency), self.max_concurrency))
+        self.decrease_interval = decrease_interval
+        self.in_flight = 0
+        self.retried = 0
+        self.dropped = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        metrics.concurrency_limit.set(self.limit)
+
+    def _try_enter(self) -> bool:
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def _leave(self) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """Blocks until the number of requests in flight is below the limit, and holds a place for one request."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            self._leave()
+
+    @asynccontextmanager
+    async def slot_async(self) -> AsyncIterator[None]:
+        """Same as slot but yields to the event loop while waiting."""
+        while not self._try_enter():
+            await asyncio.sleep(0.01)
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def record(self, status:int) -> None:
+        """Adjusts the concurrency limit to the status of a response."""
+        with self._condition:
+            if status in THROTTLE_STATUSES:
+                now = time.monotonic()
+                if now - self._last_decrease < self.decrease_interval:
+                    return
+                self._last_decrease = now
+                self.limit = max(1.0, self.limit / 2)
+            elif status not in RETRY_STATUSES and status != CONNECTION_ERROR:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+                # A higher limit lets waiting requests in.
+                self._condition.notify_all()
+            else:
+                return
+            metrics.concurrency_limit.set(self.limit)
+
+    def should_retry(self, status:int, attempt:int) -> bool:
+        """
+        Args:
+            status (int): Response status, CONNECTION_ERROR for a failed request.
+            attempt (int): Number of retries already made for this request.
+
+        Returns:
+            bool: True if the request should be retried. Counts the request as retried or dropped.
+        """
+        if status not in RETRY_STATUSES and status != CONNECTION_ERROR:
+            return False
+        with self._condition:
+            if attempt < self.attempts:
+                self.retried += 1
+            else:
+                self.dropped += 1
+        if attempt < self.attempts:
+            metrics.api_retries.inc(status=str(status))
+            return True
+        metrics.api_dropped.inc(status=str(status))
+        return False
+
+    def delay(self, attempt:int, retry_after:Optional[str]=None) -> float:
+        """Seconds to wait before retry number attempt + 1. Honors the Retry-After header, with a little jitter so waiting clients don't retry at once."""
+        seconds = parse_retry_after(retry_after)
+        if seconds is not None:
+            return min(seconds, self.max_delay) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def stats(self) -> dict[str,int|float]:
+        with self._condition:
+            return {"retried":self.retried, "dropped":self.dropped, "concurrency_limit":round(self.limit, 2)}
+
+
+api_controller = RetryController()
@@ -0,0 +1,129 @@
+from typing import Optional
+
+from decouple import config
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from prh.copy_loader import COPY_BATCH_SIZE, CopyLoader
+from prh.db import build_engine, get_output_engine, set_output_engine
+from prh.models import Company, create_tables
+from prh.writers import update_postgres_batch
+
+SQLITE_BATCH_SIZE = config("PRH_SQLITE_BATCH_SIZE", default=1000, cast=int)
+# Default batch of the ON CONFLICT writer. 0 writes one company per transaction with Company.update_postgres.
+POSTGRES_BATCH_SIZE = config("PRH_POSTGRES_BATCH_SIZE", default=500, cast=int)
+
+
+class StorageBackend:
+    """
+    Output database behind the upload path. A backend writes batches of companies with the fastest bulk primitive
+    of its database engine, through the process-wide output engine (see prh.db).
+
+    Subclasses set batch_size, the default number of companies per load() call, and implement load().
+    """
+
+    batch_size: Optional[int] = None
+
+    def __init__(self, engine:Engine) -> None:
+        self.engine = engine
+
+    def create_tables(self) -> None:
+        create_tables(self.engine)
+
+    def load(self, companies:list[Company]) -> list[bool]:
+        """
+        Writes a batch of companies.
+
+        Returns:
+            list[bool]: Upload result for each company, in the same order as companies.
+        """
+        raise NotImplementedError
+
+    def finish(self, missing:int=0) -> bool:
+        """
+        Called once after the last batch. Returns False if the run's writes couldn't be completed.
+        missing is the number of companies of the run that never reached load(), e.g. because their fetch failed.
+        """
+        return True
+
+
+class PostgresBackend(StorageBackend):
+    """
+    PostgreSQL: INSERT ... ON CONFLICT with executemany (prh.writers.update_postgres_batch), or COPY through
+    staging tables with copy_mode (prh.copy_loader.CopyLoader).
+    """
+
+    def __init__(self, engine:Engine, copy_mode:Optional[str]=None) -> None:
+        super().__init__(engine)
+        self.loader = CopyLoader(copy_mode) if copy_mode else None
+        self.batch_size = COPY_BATCH_SIZE if copy_mode else POSTGRES_BATCH_SIZE
+
+    def load(self, companies:list[Company]) -> list[bool]:
+        if self.loader:
+            return self.loader.load(companies)
+        return update_postgres_batch(companies)
+
+    def finish(self, missing:int=0) -> bool:
+        return self.loader.finish(missing) if self.loader else True
+
+
+class SQLiteBackend(StorageBackend):
+    """
+    Embedded SQLite file, for local development and edge deployments without a database server.
+    Batches are written in one transaction with executemany, which SQLite runs as one prepared statement.
+    The file is switched to WAL mode with synchronous=NORMAL, so a commit doesn't wait for an fsync.
+    Missing tables are created when the backend is opened, a new file needs no separate setup step.
+    """
+
+    batch_size = SQLITE_BATCH_SIZE
+
+    def __init__(self, engine:Engine, copy_mode:Optional[str]=None) -> None:
+        if copy_mode:
+            raise ValueError("copy_mode is only supported with PostgreSQL")
+        super().__init__(engine)
+        if not event.contains(engine, "connect", self._set_pragmas):
+            event.listen(engine, "connect", self._set_pragmas)
+            # Connections opened before the listener was added don't have the pragmas.
+            engine.dispose()
+        self.create_tables()
+
+    @staticmethod
+    def _set_pragmas(dbapi_connection, connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    def load(self, companies:list[Company]) -> list[bool]:
+        return update_postgres_batch(companies)
+
+
+# SQLAlchemy dialect name -> backend.
+BACKENDS: dict[str, type[StorageBackend]] = {
+    "postgresql": PostgresBackend,
+    "sqlite": SQLiteBackend
+}
+
+
+def open_backend(uri:Optional[str]=None, copy_mode:Optional[str]=None) -> StorageBackend:
+    """
+    Returns the backend for an output database URI, chosen by its scheme, e.g. "postgresql://..." or "sqlite:///prh.db".
+    A given uri also becomes the output database of the whole process, so sessions, checkpoints and create_tables use it.
+
+    Args:
+        uri (str|None): Output database. Defaults to the current output engine (POSTGRES_OUTPUT_DB).
+        copy_mode (str|None): "merge" or "replace", see prh.copy_loader.CopyLoader. PostgreSQL only.
+
+    Raises:
+        ValueError: If there is no backend for the database, or copy_mode is not supported by it.
+    """
+    if uri:
+        engine = build_engine(uri)
+        set_output_engine(engine)
+    else:
+        engine = get_output_engine()
+
+    backend_class = BACKENDS.get(engine.dialect.name)
+    if backend_class is None:
+        raise ValueError(f"No storage backend for database: '{engine.dialect.name}', expected one of {tuple(BACKENDS)}")
+    return backend_class(engine, copy_mode)
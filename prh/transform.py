@@ -0,0 +1,176 @@
+import os
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Optional
+from uuid import UUID
+
+from sqlalchemy import Table
+
+from prh.helpers import as_timestamp, convert_address_type, convert_source, convert_version, REGISTERED_ENTRY_AUTHORITY, REGISTERED_ENTRY_REGISTER, REGISTERED_ENTRY_STATUS
+
+# Columns that every extractor fills from its arguments instead of the payload.
+ROW_ID_COLUMNS = ("pk", "company_uid", "data_fetched")
+
+@lru_cache(maxsize=16384)
+def parse_date(string:Optional[str]) -> Optional[datetime]:
+    """
+    Same result as helpers.as_timestamp, but parses ISO dates with datetime.fromisoformat and caches the results.
+    The same registration and end dates repeat across millions of rows, so most calls are cache hits.
+    """
+    if not string:
+        return None
+    try:
+        return datetime.fromisoformat(string)
+    except ValueError:
+        # strptime also accepts dates without zero padding, e.g. "2020-1-5".
+        return as_timestamp(string)
+
+def _lookup(mapping:dict) -> Callable:
+    return mapping.get
+
+# Table name -> column name -> (payload key, converter). Mirrors the from_dict of each model.
+# Columns that are not listed here are left None, like from_dict leaves them.
+COLUMN_SOURCES: dict[str, dict[str, tuple[str, Optional[Callable]]]] = {
+    "company": {
+        "company_number": ("businessId", None),
+        "registration_date": ("registrationDate", parse_date),
+        "company_form": ("companyForm", None),
+        "details_uri": ("detailsUri", None),
+        "company_name": ("name", None)
+    },
+    "company_name": {
+        "source": ("version", convert_source),
+        "order": ("order", None),
+        "version": ("version", convert_version),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "name": ("name", None),
+        "language": ("language", None)
+    },
+    "address": {
+        "source": ("version", convert_source),
+        "version": ("version", convert_version),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "care_of": ("careOf", None),
+        "street": ("street", None),
+        "post_code": ("postCode", None),
+        "city": ("city", None),
+        "language": ("language", None),
+        "address_type": ("type", convert_address_type),
+        "country": ("country", None)
+    },
+    "company_form": {
+        "source": ("version", convert_source),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "version": ("version", convert_version),
+        "name": ("name", None),
+        "language": ("language", None),
+        "form_type": ("type", None)
+    },
+    "liquidation": {
+        "source": ("version", convert_source),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "version": ("version", convert_version),
+        "name": ("name", None),
+        "language": ("language", None),
+        "liquidation_type": ("type", None)
+    },
+    "business_line": {
+        "source": ("version", convert_source),
+        "code": ("code", None),
+        "order": ("order", None),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "version": ("version", convert_version),
+        "name": ("name", None),
+        "language": ("language", None)
+    },
+    "registered_office": {
+        "source": ("version", convert_source),
+        "order": ("order", None),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "version": ("version", convert_version),
+        "name": ("name", None),
+        "language": ("language", None)
+    },
+    "contact_detail": {
+        "source": ("version", convert_source),
+        "version": ("version", convert_version),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "language": ("language", None),
+        "contact_type": ("type", None),
+        "value": ("value", None)
+    },
+    "registered_entry": {
+        "description": ("description", None),
+        "status": ("status", _lookup(REGISTERED_ENTRY_STATUS)),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "register": ("register", _lookup(REGISTERED_ENTRY_REGISTER)),
+        "language": ("language", None),
+        "authority": ("authority", _lookup(REGISTERED_ENTRY_AUTHORITY))
+    },
+    "business_id_change": {
+        "source": ("source", convert_source),
+        "description": ("description", None),
+        "reason": ("reason", None),
+        "change_date": ("changeDate", parse_date),
+        "old_company_number": ("oldBusinessId", None),
+        "new_company_number": ("newBusinessId", None),
+        "language": ("language", None)
+    },
+    "company_language": {
+        "source": ("source", convert_source),
+        "version": ("version", convert_version),
+        "registration_date": ("registrationDate", parse_date),
+        "end_date": ("endDate", parse_date),
+        "name": ("name", None),
+        "language": ("language", None)
+    }
+}
+
+RowExtractor = Callable[[str, str, datetime, dict], dict]
+
+def compile_row_extractor(table:Table) -> RowExtractor:
+    """
+    Builds a function that maps one PRH payload dict to a row of the table as a column name -> value dict,
+    with the same values the model's from_dict would set. The column list and converters are resolved once here
+    instead of for every row.
+
+    Args:
+        table (Table): Table listed in COLUMN_SOURCES.
+
+    Returns:
+        RowExtractor: extractor(pk, company_uid, data_fetched, data) -> row.
+    """
+    sources = COLUMN_SOURCES[table.name]
+    has_company_uid = "company_uid" in table.columns
+    # Every column gets a key so that all rows of a table can go to one executemany.
+    empty_row = {column.name: None for column in table.columns}
+    plain = tuple((column, key) for column, (key, converter) in sources.items() if converter is None)
+    converted = tuple((column, key, converter) for column, (key, converter) in sources.items() if converter is not None)
+
+    def extract(pk:str, company_uid:str, data_fetched:datetime, data:dict) -> dict:
+        row = empty_row.copy()
+        row["pk"] = pk
+        if has_company_uid:
+            row["company_uid"] = company_uid
+        row["data_fetched"] = data_fetched
+        get = data.get
+        for column, key in plain:
+            row[column] = get(key)
+        for column, key, converter in converted:
+            row[column] = converter(get(key))
+        return row
+
+    return extract
+
+def new_pks(count:int) -> list[str]:
+    """count random version 4 UUID strings, drawing the random bytes with one os.urandom call."""
+    random_bytes = os.urandom(16 * count)
+    return [str(UUID(bytes=random_bytes[i:i + 16], version=4)) for i in range(0, 16 * count, 16)]
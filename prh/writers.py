@@ -0,0 +1,175 @@
+from typing import Optional, Type
+
+from sqlalchemy import String, any_, bindparam, delete, insert, select, update
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+from prh.logging_config import my_project_logger
+from prh.models import CHILD_MODELS, RECONCILE_CHILD_ROWS, BaseCompanyModel, Company, content_columns, diff_child_rows
+
+
+# Dialects whose INSERT supports ON CONFLICT ... DO UPDATE.
+UPSERT_INSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+
+def _dialect(session:Session) -> str:
+    return session.get_bind().dialect.name
+
+
+def _upsert_companies(session:Session, companies:list[Company]) -> None:
+    table = BaseCompanyModel.__table__
+    stmt = UPSERT_INSERTS[_dialect(session)](table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.pk],
+        set_={column.name: stmt.excluded[column.name] for column in table.columns if not column.primary_key}
+    )
+    session.execute(stmt, [company.base_row() for company in companies])
+
+
+def _replace_child_rows(session:Session, companies:list[Company]) -> None:
+    rows_by_model: dict[Type, list[dict]] = {}
+    for company in companies:
+        for model, rows in company.child_rows().items():
+            rows_by_model.setdefault(model, []).extend(rows)
+
+    for model, rows in rows_by_model.items():
+        table = model.__table__
+        # Like update_postgres, only the tables a company has new rows for are replaced.
+        uids = list({row["company_uid"] for row in rows})
+        session.execute(delete(table).where(_any_of(session, table.c.company_uid, "uids")), {"uids": uids})
+        session.execute(insert(table), rows)
+
+
+def _any_of(session:Session, column, name:str):
+    """column = ANY(:name) with one array parameter on PostgreSQL, an expanding IN (...) elsewhere."""
+    if _dialect(session) == "postgresql":
+        return column == any_(bindparam(name, type_=ARRAY(String)))
+    return column.in_(bindparam(name, expanding=True))
+
+
+def _reconcile_child_rows(session:Session, companies:list[Company]) -> None:
+    new_rows: dict[Type, dict[str, list[dict]]] = {model: {} for model in CHILD_MODELS}
+    for company in companies:
+        for model, rows in company.child_rows().items():
+            new_rows[model][company.company_uid] = rows
+
+    uids = [company.company_uid for company in companies]
+    for model in CHILD_MODELS:
+        table = model.__table__
+        existing_rows: dict[str, list[dict]] = {}
+        result = session.execute(
+            select(table.c.pk, table.c.company_uid, *content_columns(model)).where(_any_of(session, table.c.company_uid, "uids")),
+            {"uids": uids}
+        ).mappings()
+        for row in result:
+            existing_rows.setdefault(row["company_uid"], []).append(row)
+
+        delete_pks, insert_rows = [], []
+        for uid in uids:
+            company_delete_pks, company_insert_rows = diff_child_rows(model, existing_rows.get(uid, []), new_rows[model].get(uid, []))
+            delete_pks.extend(company_delete_pks)
+            insert_rows.extend(company_insert_rows)
+
+        if delete_pks:
+            session.execute(delete(table).where(_any_of(session, table.c.pk, "pks")), {"pks": delete_pks})
+        if insert_rows:
+            session.execute(insert(table), insert_rows)
+
+
+def _skip_unchanged(session:Session, companies:list[Company]) -> list[Company]:
+    """Only touches data_fetched of the companies whose stored payload hash matches. Returns the companies that changed."""
+    table = BaseCompanyModel.__table__
+    stored_hashes = dict(session.execute(
+        select(table.c.pk, table.c.payload_hash).where(_any_of(session, table.c.pk, "uids")),
+        {"uids": [company.company_uid for company in companies]}
+    ).all())
+
+    changed, unchanged = [], []
+    for company in companies:
+        company.skipped = company.skip_unchanged and stored_hashes.get(company.company_uid) == company.payload_hash
+        (unchanged if company.skipped else changed).append(company)
+
+    if unchanged:
+        session.execute(
+            update(table).where(table.c.pk == bindparam("b_pk")).values(data_fetched=bindparam("b_data_fetched")),
+            [{"b_pk": company.company_uid, "b_data_fetched": company.data_fetched} for company in unchanged]
+        )
+    return changed
+
+
+def _write_batch(session:Session, companies:list[Company], reconcile:bool) -> None:
+    companies = _skip_unchanged(session, companies)
+    if not companies:
+        return
+    # The company rows are written first due to FK constraints.
+    _upsert_companies(session, companies)
+    if reconcile:
+        _reconcile_child_rows(session, companies)
+    else:
+        _replace_child_rows(session, companies)
+
+
+def unique_by_uid(companies:list[Company]) -> list[Company]:
+    # ON CONFLICT can't touch the same row twice in one statement, the last occurrence of a company wins.
+    return list({company.company_uid: company for company in companies}.values())
+
+
+def update_postgres_batch(companies:list[Company], reconcile:Optional[bool]=None) -> list[bool]:
+    """
+    Writes many companies to the output database in one transaction.
+    Company rows are upserted with INSERT ... ON CONFLICT (pk) DO UPDATE, the child rows are deleted with a
+    single DELETE ... WHERE company_uid = ANY(:uids) per table and inserted with executemany.
+    On SQLite the same statements are used, with IN (...) instead of ANY.
+
+    The batch is first written inside one savepoint. If that fails, each company is retried in its own
+    savepoint so that one bad record only fails that company.
+
+    With reconcile the child rows are instead compared to the existing rows, and only the added and removed rows are written.
+    Companies whose stored payload hash matches only get their data_fetched updated and are marked skipped.
+
+    Args:
+        companies (list[Company]): Companies to write.
+        reconcile (bool|None): Defaults to PRH_RECONCILE_CHILD_ROWS.
+
+    Returns:
+        list[bool]: Upload result for each company, in the same order as companies.
+    """
+    if not companies:
+        return []
+    if reconcile is None:
+        reconcile = RECONCILE_CHILD_ROWS
+
+    session = Company._create_session()
+    if session is False:
+        return [False] * len(companies)
+
+    try:
+        try:
+            with session.begin_nested():
+                _write_batch(session, unique_by_uid(companies), reconcile)
+            results = {company.company_uid: True for company in companies}
+
+        except SQLAlchemyError as e:
+            my_project_logger.warning("Batch write of %s companies failed, retrying one by one, error message: %s", len(companies), e)
+            results = {}
+            for company in unique_by_uid(companies):
+                try:
+                    with session.begin_nested():
+                        _write_batch(session, [company], reconcile)
+                    results[company.company_uid] = True
+                except SQLAlchemyError as e:
+                    my_project_logger.error("Error committing models to PostgreSQL, company_uid: %s, company number: %s, error message: %s", company.company_uid, company.company_number, e)
+                    results[company.company_uid] = False
+
+        session.commit()
+        return [results[company.company_uid] for company in companies]
+
+    except Exception as e:
+        my_project_logger.error("Error committing batch of %s companies to PostgreSQL, error message: %s", len(companies), e)
+        session.rollback()
+        return [False] * len(companies)
+
+    finally:
+        session.close()
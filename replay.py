@@ -0,0 +1,81 @@
+import argparse
+import json
+from datetime import datetime
+from typing import Iterator, Union
+
+from prh.archive import iter_archive
+from prh.copy_loader import COPY_MODES
+from prh.metrics import finish_run, metrics, profiler
+from prh.models import Company
+from prh.parquet_sink import PARQUET_BATCH_SIZE, ParquetSink
+from prh.pipeline import upload_companies
+from prh.storage import open_backend
+from bulk import summarize
+
+def companies_from_archive(archive_dir:str) -> Iterator[tuple[str, Company]]:
+    """Builds the companies from the raw payloads in the archive. data_fetched is the time the payload was fetched."""
+    for record in iter_archive(archive_dir):
+        data = record.get("data")
+        if not data:
+            continue
+        # A company fetched once for several input rows is stored again under each of their company_uids.
+        for company_uid in record.get("company_uids") or [record.get("company_uid")]:
+            with metrics.transform_seconds.time(), profiler.maybe_profile():
+                company = Company(company_uid=company_uid, **data)
+            company.data_fetched = datetime.fromisoformat(record.get("fetched_at"))
+            # The point of a replay is to rewrite rows after a mapping change, so unchanged payloads are not skipped.
+            company.skip_unchanged = False
+            yield record.get("company_number"), company
+
+def replay_run(archive_dir:str, batch_size:int|None=None, copy_mode:str|None=None, parquet_dir:str|None=None, output_uri:str|None=None) -> Union[list[dict[str,str|bool]],False]:
+    """
+    Loads the raw payloads archived by bulk_run(archive_dir=...) to the output database without calling the API.
+    Use it to re-derive the tables after a change in prh/models.py or prh/helpers.py.
+
+    Arguments:
+        archive_dir (str): Directory of the archive.
+        batch_size (int|None): Same as in bulk_run.
+        copy_mode (str|None): Same as in bulk_run.
+        parquet_dir (str|None): Same as in bulk_run, exports the archive to Parquet files.
+        output_uri (str|None): Same as in bulk_run.
+
+    Returns:
+        upload_results (list[dict[str,str|bool]]): Same as bulk_run.
+    """
+    if parquet_dir and (copy_mode or output_uri):
+        raise ValueError("parquet_dir can't be used together with copy_mode or output_uri")
+    if copy_mode and batch_size == 0:
+        raise ValueError("copy_mode loads in batches, batch_size can't be 0")
+
+    sink = backend = None
+    if parquet_dir:
+        sink = ParquetSink(parquet_dir)
+        batch_writer = sink.load
+        batch_size = batch_size or PARQUET_BATCH_SIZE
+    else:
+        backend = open_backend(output_uri, copy_mode)
+        batch_writer = backend.load
+        batch_size = backend.batch_size if batch_size is None else batch_size
+
+    try:
+        upload_results = list(upload_companies(companies_from_archive(archive_dir), batch_size, batch_writer))
+    finally:
+        sink_finished = sink.finish() if sink else True
+        finish_run()
+
+    if (backend and not backend.finish()) or not sink_finished:
+        return False
+    return upload_results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("archive_dir", type=str, help="Directory of the raw response archive")
+    parser.add_argument("--batch_size", type=int, help="Companies written per transaction", default=None)
+    parser.add_argument("--copy_mode", type=str, choices=COPY_MODES, help="Load with PostgreSQL COPY", default=None)
+    parser.add_argument("--parquet_dir", type=str, help="Write Parquet files to this directory instead of PostgreSQL", default=None)
+    parser.add_argument("--output", type=str, help="Output database URI, e.g. sqlite:///prh.db. Defaults to POSTGRES_OUTPUT_DB", default=None)
+    args = parser.parse_args()
+
+    upload_results = replay_run(args.archive_dir, args.batch_size, args.copy_mode, args.parquet_dir, args.output)
+    print(summarize(upload_results))
+    print(json.dumps(metrics.summary()))
@@ -0,0 +1,22 @@
+import argparse
+
+from prh.logging_config import my_project_logger
+from prh.lookup import LookupService, make_server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resident single company lookup service, GET /company/<company number>")
+    parser.add_argument("--host", type=str, help="Address to listen on", default="0.0.0.0")
+    parser.add_argument("--port", type=int, help="Port to listen on", default=8080)
+    parser.add_argument("--output", type=str, help="Output database URI, e.g. sqlite:///prh.db. Defaults to POSTGRES_OUTPUT_DB", default=None)
+    args = parser.parse_args()
+
+    service = LookupService(args.output)
+    server = make_server(service, args.host, args.port)
+    my_project_logger.warning("Lookup service listening on %s:%s", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -1,21 +1,27 @@
 import argparse
+import json
 
 from decouple import config
 
 from prh.fetch import get_data
-from prh.models import Company
+from prh.helpers import normalize_company_number
+from prh.metrics import finish_run, metrics
+from prh.pipeline import build_company
 
 def single_company(company_number:str, company_uid:str|None=None) -> tuple[str,bool]:
+    # Accepts the number without the dash or the leading zero too.
+    company_number = normalize_company_number(company_number) or company_number
     input_packet = [{"company_number":company_number, "company_uid":company_uid}]
     data_list = get_data(input_packet)
 
     if not data_list:
         return {"company_number":company_number, "upload_result":False}
     company_number = data_list[0].get("company_number")
-    company_uid = data_list[0].get("company_uid")
-    data = data_list[0].get("data")
+    company = build_company(data_list[0])
 
-    upload_result = Company(company_uid=company_uid, **data).to_postgres()
+    with metrics.write_seconds.time(writer="company"):
+        upload_result = company.to_postgres()
+    metrics.count_upload(upload_result, skipped=False)
     return {"company_number":company_number, "upload_result":upload_result}
 
 if __name__ == "__main__":
@@ -26,4 +32,5 @@ if __name__ == "__main__":
 
     upload_results = single_company(args.company_number, args.company_uid)
     print(upload_results)
+    print(json.dumps(finish_run()))
     
\ No newline at end of file
@@ -0,0 +1,67 @@
+import pytest
+
+from prh.helpers import (REJECTED_CHECK_DIGIT, REJECTED_FORMAT, company_number_check_digit, company_number_variants, in_shard,
+                         is_valid_company_number, normalize_company_number, parse_company_number)
+
+
+def _check_digit(digits:str) -> int|None:
+    # The definition of the Y-tunnus check digit, without the precomputed tables.
+    remainder = sum(int(digit) * weight for digit, weight in zip(digits, (7, 9, 10, 5, 8, 4, 2))) % 11
+    if remainder == 1:
+        return None
+    return 0 if remainder == 0 else 11 - remainder
+
+
+@pytest.mark.parametrize("digits", ["0112038", "0116297", "1234567", "0000000", "9999999", "2331972", "0737546"])
+def test_check_digit_matches_definition(digits):
+    assert company_number_check_digit(digits) == _check_digit(digits)
+
+
+def test_check_digit_remainder_one_has_no_check_digit():
+    digits = next(f"{n:07d}" for n in range(10**7) if _check_digit(f"{n:07d}") is None)
+    assert company_number_check_digit(digits) is None
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("0112038-9", "0112038-9"),
+    ("01120389", "0112038-9"),
+    ("112038-9", "0112038-9"),
+    (" 0112038-9\n", "0112038-9"),
+])
+def test_parse_normalizes(value, expected):
+    assert parse_company_number(value) == (expected, None)
+
+
+@pytest.mark.parametrize("value", [None, 1120389, "", "11203", "0112038-", "01120-389", "A112038-9", "00112038-9"])
+def test_parse_rejects_format(value):
+    assert parse_company_number(value) == (None, REJECTED_FORMAT)
+
+
+def test_parse_rejects_check_digit():
+    assert parse_company_number("0112038-8") == (None, REJECTED_CHECK_DIGIT)
+    assert normalize_company_number("0112038-8") is None
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("0112038-9", True),
+    ("01120389", False),
+    ("0112038-8", False),
+    (None, False),
+    (1120389, False),
+])
+def test_is_valid_company_number(value, expected):
+    assert is_valid_company_number(value) is expected
+
+
+@pytest.mark.parametrize("count", [2, 3, 8, 16])
+def test_variants_land_in_the_same_shard(count):
+    for value in ("0112038-9", "01120389", "112038-9", " 0112038-9 "):
+        assert [in_shard(value, (index, count)) for index in range(count)] == [in_shard("0112038-9", (index, count)) for index in range(count)]
+    assert sum(in_shard("0112038-8", (index, count)) for index in range(count)) == 1
+
+
+def test_variants_normalize_to_the_number():
+    assert company_number_variants("0112038-9") == ["0112038-9", "01120389", "112038-9", "1120389"]
+    assert company_number_variants("1234567-1") == ["1234567-1", "12345671"]
+    for variant in company_number_variants("0112038-9"):
+        assert normalize_company_number(variant) == "0112038-9"
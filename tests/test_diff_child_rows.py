@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from prh.models import CompanyNameModel, diff_child_rows
+
+
+def _name(pk:str|None, name:str, version:str="current", data_fetched:datetime|None=None) -> dict:
+    return {"pk":pk, "company_uid":"a", "source":"prh", "order":"0", "version":version, "registration_date":"2020-01-01",
+            "end_date":None, "name":name, "language":"fi", "data_fetched":data_fetched or datetime(2024, 1, 1)}
+
+
+def test_unchanged_rows_are_kept():
+    existing = [_name("1", "Oy A"), _name("2", "Oy B")]
+    new = [_name(None, "Oy B", data_fetched=datetime(2024, 6, 1)), _name(None, "Oy A", data_fetched=datetime(2024, 6, 1))]
+
+    assert diff_child_rows(CompanyNameModel, existing, new) == ([], [])
+
+
+def test_changed_rows_are_replaced():
+    existing = [_name("1", "Oy A"), _name("2", "Oy B")]
+    new = [_name(None, "Oy A"), _name(None, "Oy B", version="former"), _name(None, "Oy C")]
+
+    delete_pks, insert_rows = diff_child_rows(CompanyNameModel, existing, new)
+
+    assert delete_pks == ["2"]
+    assert [(row["name"], row["version"]) for row in insert_rows] == [("Oy B", "former"), ("Oy C", "current")]
+
+
+def test_duplicate_rows_are_counted():
+    existing = [_name("1", "Oy A"), _name("2", "Oy A"), _name("3", "Oy A")]
+
+    assert diff_child_rows(CompanyNameModel, existing, [_name(None, "Oy A")]) == (["2", "3"], [])
+    assert diff_child_rows(CompanyNameModel, existing[:1], [_name(None, "Oy A")] * 2) == ([], [_name(None, "Oy A")])
+
+
+def test_datetime_matches_value_read_back_as_string():
+    # registration_date is a String column, a datetime written to it is read back as its str().
+    new = {**_name(None, "Oy A"), "registration_date":datetime(2020, 1, 1)}
+    existing = {**_name("1", "Oy A"), "registration_date":"2020-01-01 00:00:00"}
+
+    assert diff_child_rows(CompanyNameModel, [existing], [new]) == ([], [])
@@ -0,0 +1,39 @@
+from prh.input_filter import InputFilter, expand_duplicates
+
+
+def test_clean_rejects_normalizes_and_merges():
+    input_filter = InputFilter()
+    rows = input_filter.clean([
+        {"company_number":"0112038-9", "company_uid":"a"},
+        {"company_number":"01120389", "company_uid":"b"},
+        {"company_number":"0112038-8", "company_uid":"c"},
+        {"company_number":None, "company_uid":"d"},
+        {"company_number":"0116297-6", "company_uid":"e"},
+        {"company_number":"0112038-9", "company_uid":"a"},
+    ])
+
+    assert rows == [
+        {"company_number":"0112038-9", "company_uid":"a", "company_uids":["a", "b"]},
+        {"company_number":"0116297-6", "company_uid":"e", "company_uids":["e"]},
+    ]
+    assert input_filter.stats() == {
+        "read":6, "accepted":2, "normalized":1, "duplicates":2, "rejected_format":1, "rejected_check_digit":1
+    }
+
+
+def test_clean_stream_deduplicates_within_window():
+    rows = [{"company_number":"0112038-9", "company_uid":str(index)} for index in range(5)]
+
+    cleaned = list(InputFilter().clean_stream(rows, window=2))
+
+    assert [row["company_uids"] for row in cleaned] == [["0", "1"], ["2", "3"], ["4"]]
+
+
+def test_expand_duplicates():
+    fetched = {"company_number":"0112038-9", "company_uid":"a", "data":{"businessId":"0112038-9"}}
+
+    assert expand_duplicates(None, ["a", "b"]) == []
+    assert expand_duplicates(fetched, None) == [fetched]
+    assert expand_duplicates(fetched, ["a"]) == [fetched]
+    assert [item["company_uid"] for item in expand_duplicates(fetched, ["a", "b"])] == ["a", "b"]
+    assert all(item["data"] is fetched["data"] for item in expand_duplicates(fetched, ["a", "b"]))
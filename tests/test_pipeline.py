@@ -0,0 +1,35 @@
+import time
+
+import pytest
+
+from prh.pipeline import _timed_batches
+
+
+def slow_tail(items:list, delay:float):
+    for item in items:
+        yield item
+    time.sleep(delay)
+    yield "late"
+
+
+def test_full_batches_are_yielded_by_count():
+    assert list(_timed_batches(range(7), 3, 10)) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_partial_batch_is_yielded_after_max_wait():
+    batches = _timed_batches(slow_tail([1, 2], 1.0), 500, 0.05)
+    started = time.monotonic()
+    assert next(batches) == [1, 2]
+    assert time.monotonic() - started < 0.5
+    assert list(batches) == [["late"]]
+
+
+def test_read_error_is_raised_after_the_last_batch():
+    def failing():
+        yield 1
+        raise RuntimeError("input failed")
+
+    batches = _timed_batches(failing(), 10, 10)
+    assert next(batches) == [1]
+    with pytest.raises(RuntimeError):
+        next(batches)
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+import prh.rate_limit
+from prh.rate_limit import TokenBucket
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds:float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    async def async_sleep(self, seconds:float) -> None:
+        self.sleep(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(prh.rate_limit.time, "time", clock.time)
+    monkeypatch.setattr(prh.rate_limit.time, "sleep", clock.sleep)
+    monkeypatch.setattr(prh.rate_limit.asyncio, "sleep", clock.async_sleep)
+    return clock
+
+
+def _bucket(tmp_path, **kwargs) -> TokenBucket:
+    # 3 stored tokens plus a refill of one token per second.
+    return TokenBucket(**{"calls":63, "period":60, "burst":3, "db_path":str(tmp_path / "ratelimit.db"), **kwargs})
+
+
+def test_burst_is_taken_without_waiting(tmp_path, clock):
+    bucket = _bucket(tmp_path)
+
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert clock.sleeps == []
+
+
+def test_waits_for_refill_when_empty(tmp_path, clock):
+    bucket = _bucket(tmp_path)
+    for _ in range(3):
+        bucket.acquire()
+
+    assert bucket.acquire() == pytest.approx(1.0)
+    assert bucket.acquire() == pytest.approx(1.0)
+
+
+def test_refill_is_capped_at_burst(tmp_path, clock):
+    bucket = _bucket(tmp_path)
+    for _ in range(3):
+        bucket.acquire()
+    clock.now += 3600
+
+    assert [bucket.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.acquire() == pytest.approx(1.0)
+
+
+def test_buckets_on_the_same_file_share_the_budget(tmp_path, clock):
+    first, second = _bucket(tmp_path), _bucket(tmp_path)
+    first.acquire()
+    first.acquire()
+    second.acquire()
+
+    assert second.acquire() == pytest.approx(1.0)
+    assert _bucket(tmp_path, name="other").acquire() == 0.0
+
+
+def test_acquire_async(tmp_path, clock):
+    bucket = _bucket(tmp_path, calls=61, burst=1)
+
+    assert asyncio.run(bucket.acquire_async()) == 0.0
+    assert asyncio.run(bucket.acquire_async()) == pytest.approx(1.0)
+
+
+def test_burst_is_part_of_the_budget(tmp_path, clock):
+    bucket = _bucket(tmp_path, calls=10, burst=4)
+    started = clock.now
+    calls = 0
+    while clock.now - started < 60:
+        bucket.acquire()
+        calls += 1
+
+    assert calls <= 10